@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+# Benchmarks of the library's build stages against generated repositories.
+# Run as
+#   python -m w3ctestlib.Benchmark --tests 500 --repeat 5 --json bench.json
+# and compare the reported timings between revisions; the repository
+# generator is deterministic for a given seed.
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+from os.path import join, exists, dirname, abspath
+from timeit import default_timer as timer
+import OutputFormats
+from Sources import SourceTree, SourceCache, XMLSource, ReftestManifest, htmlParsers, setHTMLParser
+from Groups import TestGroup
+from Suite import TestSuite
+from Indexer import Indexer
+from template import Template
+
+# the package path may be relative, benchmarks run in the repository root
+templateDir = abspath(join(dirname(__file__), 'templates'))
+
+class SyntheticRepository:
+  """Generator for CSS test repositories of a given shape. Tests are laid
+     out like an approved test directory:
+       approved/bench/src/               tests and reference chains
+       approved/bench/src/support/       support files
+       approved/bench/manifestN/         reftest.list manifests and their files
+  """
+
+  xhtmlTest = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+ <head>
+  <title>CSS Test: %(title)s</title>
+  <link rel="author" title="%(author)s" href="mailto:%(author)s@example.org"/>
+  <link rel="help" href="%(help)s"/>
+  %(refs)s
+  <meta name="flags" content="%(flags)s"/>
+  <meta name="assert" content="%(title)s &amp; more."/>
+  <style type="text/css">p { color: green; background: url(support/%(support)s); }</style>
+ </head>
+ <body>
+  <p>Test passes if there is green text&#xA0;below.</p>
+  %(body)s
+ </body>
+</html>
+'''
+
+  htmlTest = '''<!DOCTYPE html>
+<html>
+ <head>
+  <title>CSS Test: %(title)s</title>
+  <link rel="author" title="%(author)s" href="mailto:%(author)s@example.org">
+  <link rel="help" href="%(help)s">
+  %(refs)s
+  <meta name="flags" content="%(flags)s">
+  <meta name="assert" content="%(title)s &amp; more.">
+  <style>p { color: green; background: url(support/%(support)s); }</style>
+ </head>
+ <body>
+  <p>Test passes if there is green text&nbsp;below.
+  %(body)s
+ </body>
+</html>
+'''
+
+  svgTest = '''<svg xmlns="http://www.w3.org/2000/svg" xmlns:h="http://www.w3.org/1999/xhtml" version="1.1">
+ <g id="testmeta">
+  <title>CSS Test: %(title)s</title>
+  <h:link rel="author" title="%(author)s" href="mailto:%(author)s@example.org"/>
+  <h:link rel="help" href="%(help)s"/>
+  %(refs)s
+  <metadata class="flags">%(flags)s</metadata>
+  <desc class="assert">%(title)s &amp; more.</desc>
+ </g>
+ <rect width="100" height="100" fill="green"/>
+</svg>
+'''
+
+  reference = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+ <head>
+  <title>CSS Reftest Reference</title>
+  <link rel="author" title="reference" href="mailto:reference@example.org"/>
+  %(refs)s
+ </head>
+ <body>
+  <p>Test passes if there is green text&#xA0;below.</p>
+  %(body)s
+ </body>
+</html>
+'''
+
+  flagSets = ['', 'ahem', 'image', 'ahem image', 'HTMLonly', 'nonHTML', 'dom']
+
+  def __init__(self, tests = 100, mix = None, refDepth = 1, reftestRatio = 0.5,
+               supportFiles = 10, manifests = 0, manifestTests = 10,
+               sections = 20, paragraphs = 10, seed = 0):
+    """Describe a repository of `tests` tests, with file extensions picked
+       by the weights of dictionary `mix` (default {'.xht': 6, '.htm': 3,
+       '.svg': 1}). `reftestRatio` of the tests are reftests, each with a
+       chain of `refDepth` references. `manifests` directories each hold a
+       reftest.list of `manifestTests` reftests. Tests link to one of
+       `sections` spec sections and have `paragraphs` paragraphs of content.
+    """
+    self.tests = tests
+    self.mix = mix or {'.xht': 6, '.htm': 3, '.svg': 1}
+    self.refDepth = refDepth
+    self.reftestRatio = reftestRatio
+    self.supportFiles = supportFiles
+    self.manifests = manifests
+    self.manifestTests = manifestTests
+    self.sectionCount = sections
+    self.paragraphs = paragraphs
+    self.seed = seed
+
+    self.srcDir = join('approved', 'bench', 'src')
+    self.manifestDirs = [join('approved', 'bench', 'manifest%d' % index) for index in range(manifests)]
+    self.sections = [('http://www.w3.org/TR/CSS21/bench.html#section-%d' % index,
+                      '%d.%d' % (index / 10 + 1, index % 10 + 1), 'Section %d' % index)
+                     for index in range(sections)]
+    self.testNames = []
+
+  def parameters(self):
+    """Returns the generator parameters as a dictionary."""
+    return {'tests': self.tests, 'mix': self.mix, 'refDepth': self.refDepth,
+            'reftestRatio': self.reftestRatio, 'supportFiles': self.supportFiles,
+            'manifests': self.manifests, 'manifestTests': self.manifestTests,
+            'sections': self.sectionCount, 'paragraphs': self.paragraphs, 'seed': self.seed}
+
+  def _write(self, root, path, data):
+    path = join(root, path)
+    if not exists(dirname(path)):
+      os.makedirs(dirname(path))
+    f = open(path, 'w')
+    f.write(data)
+    f.close()
+
+  def _extensions(self, rng, count):
+    """Returns `count` file extensions distributed by self.mix."""
+    total = sum(self.mix.values())
+    exts = []
+    for ext, weight in sorted(self.mix.items()):
+      exts += [ext] * int(round(count * float(weight) / total))
+    exts = (exts + [sorted(self.mix)[0]] * count)[:count]
+    rng.shuffle(exts)
+    return exts
+
+  def _testData(self, rng, ext, title, refs):
+    if ('.svg' == ext):
+      template = self.svgTest
+      refLinks = ''.join('<h:link rel="%s" href="%s"/>' % ref for ref in refs)
+    elif ('.htm' == ext):
+      template = self.htmlTest
+      refLinks = ''.join('<link rel="%s" href="%s">' % ref for ref in refs)
+    else:
+      template = self.xhtmlTest
+      refLinks = ''.join('<link rel="%s" href="%s"/>' % ref for ref in refs)
+    return template % {
+      'title': title,
+      'author': 'author%d' % rng.randint(0, 20),
+      'help': rng.choice(self.sections)[0],
+      'refs': refLinks,
+      'flags': rng.choice(self.flagSets),
+      'support': 'support-%d.png' % rng.randint(0, max(self.supportFiles - 1, 0)),
+      'body': self._body(rng),
+    }
+
+  def _body(self, rng):
+    return '\n  '.join('<p class="c%d">Filler &amp; <em>text</em> &lt;%d&gt;.</p>' % (rng.randint(0, 9), index)
+                       for index in range(self.paragraphs))
+
+  def _referenceChain(self, root, rng, dir, name):
+    """Write a chain of self.refDepth references for test `name` in `dir`,
+       returns the (rel, href) link of the first one.
+    """
+    refs = []
+    for depth in range(self.refDepth, 0, -1):
+      refName = '%s-ref%d.xht' % (name, depth)
+      refData = self.reference % {'refs': ''.join('<link rel="%s" href="%s"/>' % ref for ref in refs),
+                                  'body': self._body(rng)}
+      self._write(root, join(dir, refName), refData)
+      refs = [('match', refName)]
+    return refs
+
+  def generate(self, root):
+    """Write the repository into directory `root`."""
+    rng = random.Random(self.seed)
+    self.testNames = []
+    for index in range(self.supportFiles):
+      if (index % 2):
+        self._write(root, join(self.srcDir, 'support', 'support-%d.css' % index), 'p { margin: %dpx }\n' % index)
+      else:
+        self._write(root, join(self.srcDir, 'support', 'support-%d.png' % index), '\x89PNG\r\n\x1a\n' + str(index) * 64)
+    self._write(root, join(self.srcDir, '.htaccess'), 'AddType text/html .htm\n')
+
+    for index, ext in enumerate(self._extensions(rng, self.tests)):
+      name = 'bench-%05d' % index
+      refs = []
+      if (self.refDepth and (rng.random() < self.reftestRatio)):
+        refs = self._referenceChain(root, rng, self.srcDir, name)
+      self._write(root, join(self.srcDir, name + ext), self._testData(rng, ext, name, refs))
+      self.testNames.append(name + ext)
+
+    for manifestDir in self.manifestDirs:
+      lines = []
+      for index in range(self.manifestTests):
+        name = 'manifest-%05d' % index
+        self._write(root, join(manifestDir, name + '.xht'), self._testData(rng, '.xht', name, []))
+        refName = join('reference', name + '-ref.xht')
+        self._write(root, join(manifestDir, refName), self.reference % {'refs': '', 'body': self._body(rng)})
+        lines.append('%s %s.xht %s\n' % (rng.choice(('==', '!=')), name, refName))
+      self._write(root, join(manifestDir, 'reftest.list'), ''.join(lines))
+
+
+class QuietUI:
+  """ui object discarding all messages."""
+  def write(self, *msg):
+    pass
+  status = note = warn = write
+
+
+class Benchmark:
+  """Times the build stages against a SyntheticRepository generated into
+     `root`. Each stage is set up afresh and timed `repeat` times.
+  """
+
+  stages = ('generateSource', 'group', 'scan', 'extractMetadata', 'metadata', 'serialize', 'manifest', 'index', 'build')
+
+  def __init__(self, repository, root, repeat = 3, formats = ('html4', 'xhtml1', 'xhtml1print'),
+               buildOptions = None):
+    """`buildOptions` are passed on to TestSuite.buildInto."""
+    self.repository = repository
+    self.root = root
+    self.repeat = repeat
+    self.formats = formats
+    self.buildOptions = buildOptions or {}
+    self.outputDir = None
+
+  def _group(self, sourceCache = None):
+    return TestGroup(sourceCache or SourceCache(SourceTree()), self.repository.srcDir,
+                     selfTestList = self.repository.testNames, name = '', ui = QuietUI())
+
+  def _suite(self):
+    suite = TestSuite('bench', 'Benchmark Test Suite', 'http://www.w3.org/TR/CSS21/',
+                      'http://www.w3.org/TR/CSS21/', SourceCache(SourceTree()), QuietUI())
+    suite.setFormats(self.formats)
+    suite.addGroup(self._group(suite.sourcecache))
+    return suite
+
+  def _indexer(self, suite):
+    return Indexer(suite, self.repository.sections, {'bench': {'title': 'Benchmark'}}, {},
+                   templatePathList = [templateDir], extraData = {})
+
+  def _parsedSources(self):
+    sources = [source for source in self._group().tests.iter() if isinstance(source, XMLSource)]
+    for source in sources:
+      source.loadTree()
+    return [source for source in sources if (source.tree is not None)]
+
+  def _output(self):
+    if self.outputDir:
+      shutil.rmtree(self.outputDir)
+    self.outputDir = tempfile.mkdtemp(prefix = 'w3ctestlib-bench-')
+    return self.outputDir
+
+  # Stage setups, each returns the function to time
+
+  def setupGenerateSource(self):
+    paths = []
+    for (root, dirs, files) in os.walk(self.repository.srcDir):
+      paths += [join(root, file) for file in files if file != '.htaccess']
+    def run():
+      sourceCache = SourceCache(SourceTree())
+      for path in paths:
+        sourceCache.generateSource(path, path).validate()
+    return run
+
+  def setupGroup(self):
+    return self._group
+
+  def setupScan(self):
+    return lambda: self._group(SourceCache(SourceTree(), scanMetadata = True))
+
+  def setupExtractMetadata(self):
+    sources = self._parsedSources()
+    def run():
+      for source in sources:
+        source.refs = {}
+        source.scripts = {}
+        source.errors = None
+        source.extractMetadata(source.tree)
+    return run
+
+  # test metadata read through the template engine and as dictionaries
+  metadataTemplate = \
+    "[% FOREACH test IN tests %][% test.name %]\t[% test.title %]\t[% test.flags.join(',') %]\t" \
+    "[% FOREACH refList IN test.references %][% FOREACH ref IN refList %][% ref.type %] [% ref.relpath %] " \
+    "[% END %][% END %]\t[% test.links.join(',') %]\t[% test.revision %]\t" \
+    "[% FOREACH credit IN test.credits %][% credit.0 %][% END %]\t[% test.asserts.join(' ') %]\n[% END %]"
+
+  def setupMetadata(self):
+    group = self._group()
+    tests = [data for data in (test.getMetadata() for test in group.iterTests()) if data]
+    tt = Template({'PRE_CHOMP': 1, 'POST_CHOMP': 0})
+    def run():
+      tt.processString(self.metadataTemplate, {'tests': tests})
+      for data in tests:
+        dict(data.iteritems())
+        for refGroup in data['references'] or []:
+          for ref in refGroup:
+            ref['type'], ref['relpath'], ref['repopath']
+    return run
+
+  def setupSerialize(self):
+    sources = [source for source in self._parsedSources() if hasattr(source, 'serializeHTML')]
+    def run():
+      for source in sources:
+        source.serializeHTML()
+        source.serializeXHTML()
+    return run
+
+  def setupManifest(self):
+    sourceTree = SourceTree()
+    def run():
+      for manifestDir in self.repository.manifestDirs:
+        list(ReftestManifest(sourceTree, join(manifestDir, 'reftest.list'), 'reftest.list'))
+    return run
+
+  def setupIndex(self):
+    suite = self._suite()
+    dest = self._output()
+    formats = [OutputFormats.HTMLFormat(dest, suite.sourcecache.sourceTree),
+               OutputFormats.XHTMLFormat(dest, suite.sourcecache.sourceTree)]
+    def run():
+      indexer = self._indexer(suite)
+      for group in suite.groups.itervalues():
+        indexer.indexGroup(group)
+      for format in formats:
+        indexer.writeIndex(format)
+      indexer.writeOverview(dest, errorOut = None)
+      indexer.close()
+    return run
+
+  def setupBuild(self):
+    suite = self._suite()
+    indexer = self._indexer(suite)
+    dest = self._output()
+    def run():
+      suite.buildInto(dest, indexer, **self.buildOptions)
+    return run
+
+  def timeStage(self, stage):
+    """Returns the list of timings of `stage`."""
+    setup = getattr(self, 'setup' + stage[0].upper() + stage[1:])
+    times = []
+    for index in range(self.repeat):
+      run = setup()
+      start = timer()
+      run()
+      times.append(timer() - start)
+    return times
+
+  def run(self, stages = None):
+    """Times `stages` (default all) in the repository root and returns a
+       dictionary of the repository parameters and timings per stage.
+    """
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(self.root)
+    try:
+      for stage in (stages or self.stages):
+        results[stage] = self.timeStage(stage)
+    finally:
+      os.chdir(cwd)
+      if self.outputDir:
+        shutil.rmtree(self.outputDir)
+        self.outputDir = None
+    return {'repository': self.repository.parameters(), 'repeat': self.repeat,
+            'formats': list(self.formats), 'stages': results}
+
+  @staticmethod
+  def table(results):
+    """Returns a human-readable table of `results` from run()."""
+    lines = ['%-16s %10s %10s %10s' % ('stage', 'min', 'median', 'max')]
+    for stage in Benchmark.stages:
+      times = results['stages'].get(stage)
+      if times:
+        times = sorted(times)
+        lines.append('%-16s %10.4f %10.4f %10.4f' % (stage, times[0], times[len(times) / 2], times[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = 'Benchmark w3ctestlib build stages on a synthetic test repository.')
+  parser.add_argument('--tests', type = int, default = 100, help = 'number of tests')
+  parser.add_argument('--mix', default = '.xht:6,.htm:3,.svg:1', help = 'file extension weights, e.g. .xht:6,.htm:3,.svg:1')
+  parser.add_argument('--ref-depth', type = int, default = 1, help = 'length of reference chains')
+  parser.add_argument('--reftest-ratio', type = float, default = 0.5, help = 'fraction of tests that are reftests')
+  parser.add_argument('--support', type = int, default = 10, help = 'number of support files')
+  parser.add_argument('--manifests', type = int, default = 0, help = 'number of reftest.list manifests')
+  parser.add_argument('--manifest-tests', type = int, default = 10, help = 'reftests per manifest')
+  parser.add_argument('--seed', type = int, default = 0, help = 'generator seed')
+  parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs per stage')
+  parser.add_argument('--stage', action = 'append', choices = Benchmark.stages, help = 'stage to run (default all)')
+  parser.add_argument('--jobs', type = int, default = 1, help = 'buildInto worker processes')
+  parser.add_argument('--html-parser', choices = sorted(htmlParsers), help = 'HTML parser backend (default fastest available)')
+  parser.add_argument('--repo', help = 'directory to generate the repository into (default temporary)')
+  parser.add_argument('--json', help = 'file to write the results to as JSON')
+  args = parser.parse_args(argv)
+  setHTMLParser(args.html_parser)
+
+  mix = dict((ext, float(weight)) for ext, weight in (item.split(':') for item in args.mix.split(',')))
+  repository = SyntheticRepository(args.tests, mix, args.ref_depth, args.reftest_ratio,
+                                   args.support, args.manifests, args.manifest_tests, seed = args.seed)
+  root = args.repo or tempfile.mkdtemp(prefix = 'w3ctestlib-repo-')
+  try:
+    repository.generate(root)
+    results = Benchmark(repository, root, args.repeat, buildOptions = {'jobs': args.jobs}).run(args.stage)
+  finally:
+    if not args.repo:
+      shutil.rmtree(root)
+  sys.stdout.write(Benchmark.table(results))
+  if args.json:
+    f = open(args.json, 'w')
+    json.dump(results, f, indent = 1, sort_keys = True)
+    f.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+# Build phase instrumentation. The library reports timed phases and counters
+# through the module-level functions below; they do nothing unless a
+# BuildProfiler has been activated with start().
+
+import json
+import threading
+from timeit import default_timer as timer
+
+current = None   # active BuildProfiler, if any
+
+def start(slowestCount = 20):
+  """Activate and return a new BuildProfiler."""
+  global current
+  current = BuildProfiler(slowestCount)
+  return current
+
+def stop():
+  """Deactivate and return the active BuildProfiler."""
+  global current
+  profiler = current
+  current = None
+  if profiler:
+    profiler.finish()
+  return profiler
+
+class _NoPhase(object):
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    return False
+
+_noPhase = _NoPhase()
+
+def phase(name, source = None):
+  """Context manager timing build phase `name`, attributed to FileSource
+     (or path) `source` if given.
+  """
+  return current.phase(name, source) if current else _noPhase
+
+def count(name, amount = 1):
+  """Add `amount` to counter `name`."""
+  if current:
+    current.count(name, amount)
+
+def countFile(size):
+  """Count an output file of `size` bytes."""
+  if current:
+    current.count('files')
+    current.count('bytes', size)
+
+def setContext(format = None, group = None):
+  """Attribute following phases of the calling thread to OutputFormat
+     `format` and TestGroup `group` (either may be None).
+  """
+  if current:
+    current.setContext(format, group)
+
+def context():
+  """Returns the (format, group) context of the calling thread, to be
+     passed to setContext() by a thread doing work on its behalf.
+  """
+  if current:
+    return (current.context.format, current.context.group)
+  return (None, None)
+
+
+class _Phase(object):
+  __slots__ = ('profiler', 'name', 'source', 'start', 'children')
+
+  def __init__(self, profiler, name, source):
+    self.profiler = profiler
+    self.name = name
+    self.source = source
+
+  def __enter__(self):
+    self.children = 0.0
+    self.profiler.stack.append(self)
+    self.start = timer()
+    return self
+
+  def __exit__(self, *exc):
+    elapsed = timer() - self.start
+    stack = self.profiler.stack
+    stack.pop()
+    if stack:
+      stack[-1].children += elapsed
+    self.profiler.addTime(self.name, elapsed - self.children, self.source)
+    return False
+
+
+class _Context(threading.local):
+  format = None
+  group = None
+
+
+class BuildProfiler:
+  """Accumulates exclusive time per (format, group, phase), counters per
+     (format, group, counter) and total time per source.
+  """
+
+  def __init__(self, slowestCount = 20):
+    self.slowestCount = slowestCount
+    self.context = _Context()   # per thread, see OutputFormats.OutputWriter
+    self.stack = []
+    self.times = {}        # (format, group, phase) -> [seconds, calls]
+    self.counts = {}       # (format, group, counter) -> amount
+    self.sourceTimes = {}  # source path -> seconds
+    self.countLock = threading.Lock()   # counters are also updated by OutputWriter threads
+    self.started = timer()
+    self.elapsed = None
+
+  def setContext(self, format = None, group = None):
+    self.context.format = format.formatDirName if hasattr(format, 'formatDirName') else format
+    self.context.group = group.name if hasattr(group, 'name') else group
+
+  def phase(self, name, source = None):
+    return _Phase(self, name, source)
+
+  def addTime(self, name, seconds, source = None):
+    entry = self.times.setdefault((self.context.format, self.context.group, name), [0.0, 0])
+    entry[0] += seconds
+    entry[1] += 1
+    if (source is not None):
+      path = getattr(source, 'sourcepath', source)
+      if isinstance(path, list):
+        path = ' + '.join(path)
+      self.sourceTimes[path] = self.sourceTimes.get(path, 0.0) + seconds
+
+  def count(self, name, amount = 1):
+    key = (self.context.format, self.context.group, name)
+    with self.countLock:
+      self.counts[key] = self.counts.get(key, 0) + amount
+
+  def data(self):
+    """Returns raw data for merge()."""
+    return (self.times, self.counts, self.sourceTimes)
+
+  def merge(self, data):
+    """Add raw `data` from another profiler, e.g. of a worker process."""
+    times, counts, sourceTimes = data
+    for key, (seconds, calls) in times.items():
+      entry = self.times.setdefault(key, [0.0, 0])
+      entry[0] += seconds
+      entry[1] += calls
+    for key, amount in counts.items():
+      self.counts[key] = self.counts.get(key, 0) + amount
+    for path, seconds in sourceTimes.items():
+      self.sourceTimes[path] = self.sourceTimes.get(path, 0.0) + seconds
+
+  def finish(self):
+    if (self.elapsed is None):
+      self.elapsed = timer() - self.started
+
+  def summary(self):
+    """Returns the profile as a dictionary of plain data."""
+    elapsed = self.elapsed if (self.elapsed is not None) else timer() - self.started
+    slowest = sorted(self.sourceTimes.items(), key = lambda item: item[1], reverse = True)
+    return {
+      'elapsed': elapsed,
+      'phases': [{'format': format, 'group': group, 'phase': name, 'seconds': seconds, 'calls': calls}
+                 for (format, group, name), (seconds, calls) in sorted(self.times.items())],
+      'counts': [{'format': format, 'group': group, 'counter': name, 'count': amount}
+                 for (format, group, name), amount in sorted(self.counts.items())],
+      'slowest': [{'source': path, 'seconds': seconds} for path, seconds in slowest[:self.slowestCount]],
+    }
+
+  def json(self):
+    """Returns the profile summary as a JSON string."""
+    return json.dumps(self.summary(), indent = 1, sort_keys = True)
+
+  def table(self):
+    """Returns the profile summary as a human-readable table."""
+    summary = self.summary()
+    lines = ['Build profile: %.3fs' % summary['elapsed'], '',
+             '%-14s %-20s %-12s %10s %8s' % ('format', 'group', 'phase', 'seconds', 'calls')]
+    for entry in summary['phases']:
+      lines.append('%-14s %-20s %-12s %10.3f %8d' % (entry['format'] or '-', entry['group'] or '-',
+                                                      entry['phase'], entry['seconds'], entry['calls']))
+    lines += ['', '%-14s %-20s %-12s %10s' % ('format', 'group', 'counter', 'count')]
+    for entry in summary['counts']:
+      lines.append('%-14s %-20s %-12s %10d' % (entry['format'] or '-', entry['group'] or '-',
+                                               entry['counter'], entry['count']))
+    lines += ['', 'Slowest sources:']
+    for entry in summary['slowest']:
+      lines.append('%10.3f  %s' % (entry['seconds'], entry['source']))
+    return '\n'.join(lines) + '\n'
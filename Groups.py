@@ -3,13 +3,12 @@
 # Initial code by fantasai, joint copyright 2010 W3C and Microsoft
 # Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
 
-import shutil
 import filecmp
 import os.path
 import Utils
+import BuildProfile
 from os.path import exists, join
 from Sources import SourceCache, SourceSet, ConfigSource, ReftestManifest
-from Utils import listfiles
 
 excludeDirs = ['CVS', '.svn', '.hg']
 
@@ -41,31 +40,27 @@ class TestGroup:
          the .htaccess files in its parent directory, and the `importDir`'s
          .htaccess file and support directory are relevant to the test suite.
     """
-    assert exists(importDir), "Directory to import %s does not exist" % importDir
+    sourceTree = sourceCache.sourceTree
+    assert sourceTree.exists(importDir), "Directory to import %s does not exist" % importDir
 
     # Save name
     self.name = name
     self.title = title
     
     self.ui = ui
-    
-    sourceTree = sourceCache.sourceTree
 
     # Load htaccess
     htapath = join(importDir, '.htaccess')
     self.htaccess = ConfigSource(sourceTree, htapath, '.htaccess') \
-                    if exists(htapath) else None
+                    if sourceTree.exists(htapath) else None
 
     # Load support files
     self.support = SourceSet(sourceCache)
     supportDirNames = kwargs.get('supportDirNames', ('support',))
     for supportName in supportDirNames:
       supportDir = join(importDir, supportName)
-      if exists(supportDir):
-        for (root, dirs, files) in os.walk(supportDir):
-          for dir in excludeDirs:
-            if dir in dirs:
-              dirs.remove(dir)
+      if sourceTree.exists(supportDir):
+        for (root, dirs, files) in sourceTree.walk(supportDir, excludeDirs):
           for name in files:
             sourcepath = join(root, name)
             relpath = Utils.relpath(sourcepath, importDir)
@@ -92,7 +87,7 @@ class TestGroup:
       # Import tests
       fileNameList = []
       if kwargs.get('selfTestExt'):
-        fileNameList += listfiles(importDir, kwargs['selfTestExt'])
+        fileNameList += sourceTree.listFiles(importDir, kwargs['selfTestExt'])
       if kwargs.get('selfTestList'):
         fileNameList += kwargs['selfTestList']
       for fileName in fileNameList:
@@ -102,23 +97,15 @@ class TestGroup:
           if (test.isTest()):
             self.tests.addSource(test, self.ui)
 
+    refGraph = sourceCache.refGraph
     for test in self.tests.iter():
       if (test.isReftest()):
-        usedRefs = {}
-        usedRefs[test.sourcepath] = '=='
-        def loadReferences(source): # XXX need to verify refType for mutual exclusion (ie: a == b != a)
-          for refSrcPath, refRelPath, refType in source.getReferencePaths():
-            if (exists(refSrcPath)):
-              ref = sourceCache.generateSource(refSrcPath, refRelPath)
-              source.addReference(ref)
-              if (refSrcPath not in usedRefs):
-                usedRefs[refSrcPath] = refType
-                if (ref not in self.tests):
-                  self.refs.addSource(ref, self.ui)
-                loadReferences(ref)
-            else:
-              ui.warn("Missing Reference file: ", refSrcPath, "\n  referenced from: ", source.sourcepath, "\n")
-        loadReferences(test)
+        refGraph.resolve(test, sourceCache, self.ui) # XXX need to verify refType for mutual exclusion (ie: a == b != a)
+        for ref in refGraph.closure(test):
+          if (ref not in self.tests):
+            self.refs.addSource(ref, self.ui)
+        if (self.ui):
+          refGraph.reportCycles(test, self.ui)
 
 
   def sourceCache(self):
@@ -195,7 +182,58 @@ class TestGroup:
     supportDir = join(formatDir, 'support')
     referenceDir = join(formatDir, 'reference')
     if exists(supportDir) and exists(referenceDir):
-      shutil.copytree(supportDir, join(referenceDir, 'support'))
+      format.copyTree(supportDir, join(referenceDir, 'support'))
 
     format.setSubDir()
 
+  def buildFormats(self, formats):
+    """Build Group's contents through all OutputFormats `formats`, writing
+       the outputs of each test and reference for every format in turn so
+       that formats with the same output share one serialization of it.
+       The outputs are those of build() called for each format.
+    """
+    for format in formats:
+      BuildProfile.setContext(format, self)
+      format.setSubDir(self.name)
+      if self.htaccess:
+        format.write(self.htaccess)
+      format.convert = False  # XXX hack turn off format conversion
+      self.support.write(format)
+      format.convert = True   # XXX undo hack
+
+    # build() leaves the reference paths of each source adjusted relative to
+    # the last test referencing it, adjust them the same way
+    referrers = {}
+    for test in self.tests.iter():
+      if test.refs:
+        for source in [test] + test.referenceGraph().closure(test):
+          referrers[id(source)] = test
+
+    for sources, isTests in ((self.tests, True), (self.refs, False)):
+      for source in sources.iter():
+        referrer = referrers.get(id(source))
+        source.shareSerializations()
+        for format in formats:
+          BuildProfile.setContext(format, self)
+          if referrer or (isTests and source.scripts and not format.isCurrent(source, record=False)):
+            with BuildProfile.phase('adjust', source):
+              if referrer:
+                source.adjustReferencePaths(referrer, format)
+              if isTests and source.scripts:
+                source.loadTree()
+                source.adjustScripts()
+          format.write(source)
+        source.shareSerializations(False)
+
+    for format in formats:
+      BuildProfile.setContext(format, self)
+      if self.manifest:
+        format.write(self.manifest)
+      # copy support files to reference directory (XXX temp until proper support path fixup)
+      formatDir = format.destDir()
+      supportDir = join(formatDir, 'support')
+      referenceDir = join(formatDir, 'reference')
+      if exists(supportDir) and exists(referenceDir):
+        format.copyTree(supportDir, join(referenceDir, 'support'))
+      format.setSubDir()
+
@@ -8,6 +8,23 @@ import lxml
 from lxml import etree
 import htmlentitydefs
 import copy
+import codecs
+import re
+
+
+def _escapeRegExp(codepoints):
+    """Compile a regular expression matching any of codepoints."""
+    return re.compile(u'[%s]' % u''.join(re.escape(unichr(codepoint)) for codepoint in sorted(codepoints)))
+
+def _escapeTable(codepoints, names):
+    """Map the characters of codepoints to references to the entity names
+       given by names (a dict of codepoint -> name), or to numeric references.
+    """
+    table = {}
+    for codepoint in codepoints:
+        name = names.get(codepoint)
+        table[unichr(codepoint)] = u'&%s;' % name if name else u'&#x%X;' % codepoint
+    return table
 
 
 class HTMLSerializer(object):
@@ -58,6 +75,12 @@ class HTMLSerializer(object):
 
     gXMLEntityNames = {'"': 'quot', '&': 'amp', "'": 'apos', '<': 'lt', '>': 'gt'}
 
+    # precomputed escaping, see _escape
+    gXMLEscapesRE = _escapeRegExp(gXMLEscapes)
+    gInvisibleCharsRE = _escapeRegExp(gInvisibleChars)
+    gXHTMLEscapeTable = _escapeTable(gXMLEscapes, dict((ord(char), name) for char, name in gXMLEntityNames.items()))
+    gHTMLEscapeTable = _escapeTable(gXMLEscapes, htmlentitydefs.codepoint2name)
+
     gDocTypes = {
         'html': '<!DOCTYPE html>',
         'html4':
@@ -83,39 +106,50 @@ class HTMLSerializer(object):
     }
   
 
+    gFlushChunks = 4096     # chunks buffered before writing to a stream
+
     def __init__(self):
         self._reset()
   
-    def _reset(self, xhtml = False):
-        self.mOutput = u''
+    def _reset(self, xhtml = False, stream = None, encoding = 'utf-8'):
+        self.mOutput = []
         self.mXHTML = xhtml
+        escapeTable = self.gXHTMLEscapeTable if xhtml else self.gHTMLEscapeTable
+        self.mEscapeMatch = lambda match: escapeTable[match.group()]
+        self.mStream = stream
+        # one encoder per stream, so a BOM is only written once
+        self.mEncoder = codecs.getincrementalencoder(encoding)('xmlcharrefreplace') if stream else None
 
     def _output(self, *args):
-        for arg in args:
-            self.mOutput += unicode(arg)
-
-    def _escape(self, text, escapeChars):
-        # This algorithm is O(MN) for M len(text) and N num escapable
-        # But it doesn't modify the text when N is zero (common case) and
-        # N is expected to be small (usually 1 or 2) in most other cases.
-        escapable = set()
-        for char in text:
-            if ord(char) in escapeChars:
-                escapable.add(char)
-        for char in escapable:
-            if (self.mXHTML):
-                name = self.gXMLEntityNames.get(char)
-            else:
-                name = htmlentitydefs.codepoint2name.get(ord(char))
-            escape = u'&%s;' % name if name else u'&#x%X;' % ord(char)
-            text = text.replace(char, escape)
+        self.mOutput.extend(unicode(arg) for arg in args)
+        if (self.mStream and (self.gFlushChunks < len(self.mOutput))):
+            self._flush()
+
+    def _flush(self, final = False):
+        self.mStream.write(self.mEncoder.encode(u''.join(self.mOutput), final))
+        self.mOutput = []
+
+    def _finish(self):
+        if (self.mStream):
+            self._flush(True)
+            output = None
+        else:
+            output = u''.join(self.mOutput)
+        self._reset(self.mXHTML)
+        return output
+
+    def _escape(self, text, escapeRE):
+        # Single pass over the text, escapable characters are looked up
+        # in the escape table of the current mode.
+        if (escapeRE.search(text)):
+            return escapeRE.sub(self.mEscapeMatch, text)
         return text
 
     def _escapeXML(self, text):
-        return self._escape(text, self.gXMLEscapes)
+        return self._escape(text, self.gXMLEscapesRE)
 
     def _escapeInvisible(self, text):
-        return self._escape(text, self.gInvisibleChars)
+        return self._escape(text, self.gInvisibleCharsRE)
 
     def _serializeElement(self, element, namespacePrefixes):
         qName = etree.QName(element)
@@ -265,13 +299,27 @@ class HTMLSerializer(object):
         self._reset()
         self._serializeDoctype(tree, doctype, 'html')
         self._serializeTree(tree)
-        return self.mOutput
+        return self._finish()
 
     def serializeXHTML(self, tree, doctype = None):
         self._reset(True)
         # XXX '<!xml ...' ??
         self._serializeDoctype(tree, doctype, 'xhtml11')
         self._serializeTree(tree)
-        return self.mOutput
+        return self._finish()
+
+    def writeHTML(self, tree, stream, doctype = None, encoding = 'utf-8'):
+        """Serialize tree as HTML into file object stream, in encoding."""
+        self._reset(False, stream, encoding)
+        self._serializeDoctype(tree, doctype, 'html')
+        self._serializeTree(tree)
+        self._finish()
+
+    def writeXHTML(self, tree, stream, doctype = None, encoding = 'utf-8'):
+        """Serialize tree as XHTML into file object stream, in encoding."""
+        self._reset(True, stream, encoding)
+        self._serializeDoctype(tree, doctype, 'xhtml11')
+        self._serializeTree(tree)
+        self._finish()
 
 
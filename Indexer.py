@@ -13,19 +13,124 @@ import sys
 import re
 import os
 import codecs
+import hashlib
+import marshal
+import sqlite3
 from os.path import join, exists, abspath
 from template import Template
 import w3ctestlib
-from Utils import listfiles, escapeToNamedASCII
+from Utils import listfiles, escapeToNamedASCII, AtomicFile, writeFile
 from OutputFormats import ExtensionMap
+from Sources import NamedDict, ReferenceData, UserData, ReferenceGraph
+import BuildProfile
 import shutil
 
+class IndexTables:
+  """Tables of the values shared between the TestRecords of an Indexer.
+     Flag lists, link lists, contributors and references are stored once
+     however many tests use them.
+  """
+  def __init__(self):
+    self.values = {}
+    self.references = []
+    self.referenceIds = {}
+
+  def share(self, value):
+    """Returns the shared copy of hashable `value`."""
+    return self.values.setdefault(value, value)
+
+  def strings(self, strings):
+    """Returns shared tuple of shared plain str copies of `strings`."""
+    return self.share(tuple([self.share(str(string)) for string in strings]))
+
+  def users(self, users):
+    """Returns shared tuple of shared UserData for (name, link) `users`."""
+    return self.share(tuple([self.share(UserData(self.share(str(name)), self.share(str(link))))
+                             for name, link in users]))
+
+  def referenceIdGroups(self, references):
+    """Returns shared tuple of tuples of reference table indices for
+       list of lists of ReferenceData `references`, or None.
+    """
+    if references is None:
+      return None
+    groups = []
+    for refGroup in references:
+      ids = []
+      for ref in refGroup:
+        key = (ref.name, ref.type, ref.relpath, ref.repopath)
+        refId = self.referenceIds.get(key)
+        if refId is None:
+          refId = self.referenceIds[key] = len(self.references)
+          self.references.append(ReferenceData(*[self.share(value) for value in key]))
+        ids.append(refId)
+      groups.append(self.share(tuple(ids)))
+    return self.share(tuple(groups))
+
+class TestRecord(NamedDict):
+  """Compact index record of a test's metadata. Lists are stored as
+     tuples shared through IndexTables; references as reference table
+     indices.
+  """
+  fields = ('file', 'name', 'title', 'asserts', 'credits', 'reviewers', 'flags', 'links',
+            'references', 'revision', 'selftest', 'scripttest')
+  fieldSet = frozenset(fields)
+  __slots__ = ('file', 'name', 'title', 'asserts', 'credits', 'reviewers', 'flags', 'links',
+               'referenceIds', 'revision', 'selftest', 'scripttest', 'tables')
+
+  def __init__(self, tables, file, data):
+    """Make record for test `file` from Metadata `data`."""
+    self.tables = tables
+    self.file = file
+    self.name = data.name
+    self.title = data.title
+    self.asserts = tuple(data.asserts)
+    self.credits = tables.users(data.credits)
+    self.reviewers = tables.users(data.reviewers)
+    flags = data.flags + [intern('script')] if data.scripttest else data.flags
+    self.flags = tables.strings(flags)
+    self.links = tables.strings(data.links)
+    self.referenceIds = tables.referenceIdGroups(data.references)
+    self.revision = tables.share(data.revision)
+    self.selftest = data.selftest
+    self.scripttest = data.scripttest
+
+  @property
+  def references(self):
+    if self.referenceIds is None:
+      return None
+    references = self.tables.references
+    return [[references[refId] for refId in ids] for ids in self.referenceIds]
+
+class TestRecordList(object):
+  """Template-side view of a list of TestRecords, which Template Toolkit
+     can only sort by field if they are dictionaries.
+  """
+  def __init__(self, tests=None):
+    self.tests = tests if tests is not None else []
+
+  def append(self, test):
+    self.tests.append(test)
+
+  def __iter__(self):
+    return iter(self.tests)
+
+  def __len__(self):
+    return len(self.tests)
+
+  def sort(self, field='name'):
+    field = field or 'name'
+    return sorted(self.tests, key=lambda test: str(test[field]).lower())
+
+  def size(self):
+    return len(self.tests)
+
 class Section:
   def __init__(self, uri, title, numstr):
     self.uri = uri
     self.title = title
     self.numstr = numstr
-    self.tests = []
+    self.tests = TestRecordList()
   def __cmp__(self, other):
     return cmp(self.natsortkey(), other.natsortkey())
   def chapterNum(self):
@@ -40,10 +145,98 @@ class Section:
         chunks[index] = (1, chunks[index])
     return (chunks, self.numstr)
 
+class TestRecordStore:
+  """On-disk store of indexed test records, used by streaming Indexers.
+     Records are plain-data copies of test metadata kept in an SQLite
+     database along with the spec sections each test links to.
+  """
+  def __init__(self, path=''):
+    """Open store in database file `path`; the default is a private
+       temporary database that is deleted when the store is closed.
+    """
+    self.db = sqlite3.connect(path)
+    self.db.text_factory = str
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS tests (file TEXT, sortkey TEXT, reftest INTEGER, record BLOB);
+      CREATE INDEX IF NOT EXISTS tests_sortkey ON tests (sortkey);
+      CREATE TABLE IF NOT EXISTS links (section TEXT, test INTEGER);
+      CREATE INDEX IF NOT EXISTS links_section ON links (section);
+      """)
+
+  @staticmethod
+  def plainRecord(data):
+    """Return copy of metadata dict `data` made only of plain types."""
+    record = dict(data)
+    record['credits'] = [tuple(credit) for credit in data['credits']]
+    record['reviewers'] = [tuple(reviewer) for reviewer in data['reviewers']]
+    record['links'] = [str(link) for link in data['links']]
+    if data['references']:
+      record['references'] = [[dict(ref.items()) for ref in refGroup]
+                              for refGroup in data['references']]
+    return record
+
+  def add(self, data, sections):
+    """Add test metadata dict `data`, linked to the section keys
+       in list `sections`.
+    """
+    record = marshal.dumps(self.plainRecord(data))
+    cursor = self.db.execute('INSERT INTO tests VALUES (?, ?, ?, ?)',
+                             (data['file'], str(data['name']).lower(),
+                              bool(data['references']), buffer(record)))
+    self.db.executemany('INSERT INTO links VALUES (?, ?)',
+                        [(section, cursor.lastrowid) for section in sections])
+
+  def __len__(self):
+    return self.db.execute('SELECT COUNT(*) FROM tests').fetchone()[0]
+
+  def iterTests(self, order='sortkey', reftestsOnly=False):
+    """Iterate over test records, ordered by name (or by `order`)."""
+    where = ' WHERE reftest' if reftestsOnly else ''
+    for (record,) in self.db.execute('SELECT record FROM tests%s ORDER BY %s, rowid' % (where, order)):
+      yield marshal.loads(str(record))
+
+  def sectionTests(self, section):
+    """Return list of the test records linked to section key `section`."""
+    return [marshal.loads(str(record)) for (record,) in
+            self.db.execute('SELECT tests.record FROM links JOIN tests ON links.test = tests.rowid '
+                            'WHERE links.section = ? ORDER BY links.rowid', (section,))]
+
+  def sectionTestNames(self, section):
+    """Return set of the names of tests linked to section key `section`."""
+    return set(name for (name,) in
+               self.db.execute('SELECT tests.sortkey FROM links JOIN tests ON links.test = tests.rowid '
+                               'WHERE links.section = ?', (section,)))
+
+  def close(self):
+    """Close the database; a temporary database is deleted."""
+    if self.db:
+      self.db.close()
+      self.db = None
+
+class TestRecords(object):
+  """Template-side view of the tests in a TestRecordStore. Records are
+     only loaded when a template sorts or iterates over the view.
+  """
+  def __init__(self, store, reftestsOnly=False):
+    self.store = store
+    self.reftestsOnly = reftestsOnly
+
+  def __iter__(self):
+    return self.store.iterTests(reftestsOnly=self.reftestsOnly)
+
+  def sort(self, field='name'):
+    if field in (None, '', 'name'):
+      return iter(self) # already ordered by the store
+    return sorted(self, key=lambda record: str(record.get(field)).lower())
+
+  def size(self):
+    return sum(1 for record in self) if self.reftestsOnly else len(self.store)
+
 class Indexer:
 
   def __init__(self, suite, sections, suites, flags, splitChapter=False, templatePathList=None,
-               extraData=None, overviewTmplNames=None, overviewCopyExts=('.css', 'htaccess')):
+               extraData=None, overviewTmplNames=None, overviewCopyExts=('.css', 'htaccess'),
+               streaming=False):
     """Initialize indexer with TestSuite `suite` toc data file
        `tocDataPath` and additional template paths in list `templatePathList`.
 
@@ -59,6 +252,11 @@ class Indexer:
        processed from the template path into the main build directory.
        The '.tmpl' extension, if any, is stripped from the output filename.
        The default value is ['index.htm.tmpl', 'index.xht.tmpl', 'testinfo.data.tmpl']
+       `streaming` selects a low memory mode: test records are spilled
+       to a TestRecordStore instead of being kept in memory, and the
+       line-oriented outputs (testinfo.data, reftest.list and the
+       implementation report) are written directly instead of through
+       their templates.
     """
     self.suite        = suite
     self.splitChapter = splitChapter
@@ -95,7 +293,15 @@ class Indexer:
     # Initialize storage
     self.errors = {}
     self.contributors = {}
-    self.alltests = []
+    self.tables = IndexTables()
+    self.alltests = TestRecordList()
+    self.store = TestRecordStore() if streaming else None
+
+    # BuildManifest for incremental builds and OutputFormats.OutputWriter
+    # for write-behind output, set by TestSuite.buildInto
+    self.manifest = None
+    self.writer = None
+    self._digest = None
 
   def _normalizeScheme(self, uri):
     if (uri and uri.startswith('http:')):
@@ -103,30 +309,166 @@ class Indexer:
     return uri
 
   def indexGroup(self, group):
+    self._digest = None
     for test in group.iterTests():
       data = test.getMetadata()
-      if data: # Shallow copy for template output
-        data = dict(data)
-        data['file'] = '/'.join((group.name, test.relpath)) \
-                       if group.name else test.relpath
-        if (data['scripttest']):
-            data['flags'].append(intern('script'))
-        self.alltests.append(data)
+      if data:
+        # records spilled to the store do not need to share values
+        tables = self.tables if not self.store else IndexTables()
+        data = TestRecord(tables, '/'.join((group.name, test.relpath))
+                                  if group.name else test.relpath, data)
+        sections = []
         for uri in data['links']:
           uri = self._normalizeScheme(uri)
           uri = uri.replace(self._normalizeScheme(self.suite.draftroot), self._normalizeScheme(self.suite.specroot))
           if self.sections.has_key(uri):
-            testlist = self.sections[uri].tests.append(data)
+            sections.append(uri)
+        if self.store:
+          self.store.add(data, sections)
+        else:
+          self.alltests.append(data)
+          for uri in sections:
+            self.sections[uri].tests.append(data)
         for credit in data['credits']:
           self.contributors[credit[0]] = credit[1]
       else:
         self.errors[test.sourcepath] = test.errors
 
-  def __writeTemplate(self, template, data, outfile):
-    o = self.tt.process(template, data)
-    f = open(outfile, 'w')
-    f.write(o.encode('utf-8'))
-    f.close()
+  def _indexDigest(self):
+    """Returns digest of the templates and of all indexed data."""
+    if (self._digest is None):
+      sha = hashlib.sha1()
+      for tmplDir in self.templatePath:
+        for file in sorted(listfiles(tmplDir)):
+          sha.update(file)
+          with open(join(tmplDir, file)) as f:
+            sha.update(f.read())
+      sha.update(repr((self.suite.name, self.suite.title, self.suite.specroot,
+                       self.suite.draftroot, self.splitChapter, self.suites, self.flags,
+                       sorted(self.extraData.items()) if self.extraData else None)))
+      for uriKey in sorted(self.sections):
+        section = self.sections[uriKey]
+        sha.update(repr((section.uri, section.title, section.numstr)))
+      for test in self._iterTests('file'):
+        references = [[(ref.name, ref.type, ref.relpath) for ref in refGroup]
+                      for refGroup in test['references']] if test['references'] else None
+        sha.update(repr((test['file'], test['revision'], test['flags'], references)))
+      sha.update(repr(sorted(self.errors.items())))
+      self._digest = sha.hexdigest()
+    return self._digest
+
+  def _iterTests(self, key='name'):
+    """Iterate over indexed test records in order of `key`."""
+    if self.store:
+      return self.store.iterTests('sortkey' if ('name' == key) else key)
+    return iter(sorted(self.alltests, key = lambda test: str(test[key]).lower()))
+
+  def _allTests(self, reftestsOnly=False):
+    """Returns the indexed tests for template data."""
+    if self.store:
+      return TestRecords(self.store, reftestsOnly)
+    return self.alltests
+
+  def _loadSections(self, sections):
+    """Fill in the tests of `sections` from the record store."""
+    if self.store:
+      for section in sections:
+        section.tests = self.store.sectionTests(self._normalizeScheme(section.uri))
+
+  def _unloadSections(self, sections):
+    if self.store:
+      for section in sections:
+        section.tests = TestRecordList()
+
+  @staticmethod
+  def _collapse(text):
+    return re.sub(r"\s+", " ", str(text).strip())
+
+  def _testinfoLines(self, data):
+    """Generate testinfo.data, see testinfo.data.tmpl."""
+    extmap = data['extmap']
+    yield '# Revision format %s\n' % data['revisionformat']
+    yield 'id\treferences\ttitle\tflags\tlinks\trevision\tcredits\tassertion'
+    for test in self._iterTests():
+      references = ';'.join(','.join(('!' if ('!=' == ref['type']) else '') + extmap.translate(ref['relpath'])
+                                     for ref in refList)
+                            for refList in test['references'] or [])
+      credits = ','.join('`%s`<%s>' % (credit[0], credit[1]) for credit in test['credits'])
+      yield '\n' + '\t'.join((re.sub('\.[a-z]+$', '', test['file']), references,
+                               self._collapse(test['title']), ','.join(test['flags']),
+                               ','.join(test['links']), str(test['revision']), credits,
+                               self._collapse(' '.join(test['asserts']))))
+    yield '\n'
+
+  def _reftestLines(self, data):
+    """Generate reftest.list, see reftest.tmpl."""
+    extmap = data['extmap']
+    for test in self._iterTests():
+      for refList in test['references'] or []:
+        yield extmap.translate(test['file']) + ' ' + \
+              ''.join(' %s %s' % (ref['type'], extmap.translate(ref['relpath'])) for ref in refList) + '\n'
+
+  def _reportLines(self, data):
+    """Generate the implementation report template,
+       see implementation-report-TEMPLATE.data.tmpl.
+    """
+    yield '# UA version OS version\n'
+    yield '# UA string (if applicable)\n'
+    yield '# http://test.csswg.org/suites/%s/DATESTAMP/\n' % data['suite']
+    yield '# See http://wiki.csswg.org/test/implementation-report for instructions\n'
+    yield '# Revision format %s\n' % data['revisionformat']
+    yield 'testname\trevision\tresult\tcomment\n'
+    formatInfo = data['formatInfo']
+    for test in self._iterTests():
+      for format in data['formats']:
+        info = formatInfo[format]
+        if info['report'] and (info['filter'] not in test['flags']):
+          yield '%s/%s.%s\t%s\t?\n' % (info['path'], test['name'], info['ext'], test['revision'])
+    for test in sorted(data['addtests'], key = lambda test: str(test).lower()):
+      yield '%s\t\t?\t\n' % test
+
+  # line-oriented outputs written directly by streaming Indexers, each
+  # equivalent to its built-in template; see _isOverridden()
+  streamWriters = {'testinfo.data.tmpl': _testinfoLines,
+                   'reftest.tmpl': _reftestLines,
+                   'implementation-report-TEMPLATE.data.tmpl': _reportLines}
+
+  def _isOverridden(self, template):
+    """Returns True if a directory of templatePathList provides `template`."""
+    return any(exists(join(tmplDir, template)) for tmplDir in self.templatePath[1:])
+
+  def __writeTemplate(self, template, data, outfile, *inputs):
+    """Process `template` with `data` into file `outfile`. In incremental
+       builds, the output is skipped if neither the indexed data, the
+       templates, nor the additional `inputs` changed.
+    """
+    if self.manifest:
+      digest = hashlib.sha1(repr((self._indexDigest(), template) + inputs)).hexdigest()
+      current = self.manifest.isCurrent(outfile, digest)
+      self.manifest.record(outfile, digest)
+      if current:
+        return
+    if self.store and (template in self.streamWriters) and not self._isOverridden(template):
+      with BuildProfile.phase('render', template):
+        chunks = self.streamWriters[template](self, data)
+        if self.writer:
+          o = ''.join(chunks)
+        else:
+          with AtomicFile(outfile) as f:
+            for chunk in chunks:
+              f.write(chunk)
+            size = f.tell()
+          BuildProfile.countFile(size)
+          return
+    else:
+      with BuildProfile.phase('render', template):
+        o = self.tt.process(template, data).encode('utf-8')
+    with BuildProfile.phase('write'):
+      if self.writer:
+        self.writer.write(outfile, o)
+      else:
+        writeFile(outfile, o)
+    BuildProfile.countFile(len(o))
 
   def writeOverview(self, destDir, errorOut=sys.stderr, addTests=[]):
     """Write format-agnostic pages such as test suite overview pages,
@@ -148,10 +490,11 @@ class Indexer:
     data['specroot']     = self.suite.specroot
     data['draftroot']    = self.suite.draftroot
     data['contributors'] = self.contributors
-    data['tests']        = self.alltests
+    data['tests']        = self._allTests()
     data['extmap']       = ExtensionMap({'.xht':'', '.html':'', '.htm':'', '.svg':''})
     data['formats']      = self.suite.formats
     data['addtests']     = addTests
+    data['revisionformat'] = ReferenceGraph.revisionFormat
     data['suites']       = self.suites
     data['flagInfo']     = self.flags
     data['formatInfo']   = { 'html4': { 'report': True, 'path': 'html4', 'ext': 'htm', 'filter': 'nonHTML'},
@@ -166,12 +509,15 @@ class Indexer:
       files = listfiles(tmplDir)
       for file in files:
         if self.overviewCopyExtPat.match(file):
-          shutil.copy(join(tmplDir, file), join(destDir, file))
+          if self.writer:
+            self.writer.call(join(destDir, file), shutil.copy, join(tmplDir, file), join(destDir, file))
+          else:
+            shutil.copy(join(tmplDir, file), join(destDir, file))
 
     # Generate indexes
     for tmpl in self.overviewTmplNames:
       out = tmpl[0:-5] if tmpl.endswith('.tmpl') else tmpl
-      self.__writeTemplate(tmpl, data, join(destDir, out))
+      self.__writeTemplate(tmpl, data, join(destDir, out), self.suite.formats, addTests)
 
     # Report errors
     if (self.errors):
@@ -184,6 +530,14 @@ class Indexer:
                 print >> errorOut, "Error in %s: %s" % \
                                (errorLocation, ' '.join([str(error) for error in self.errors[errorLocation]]))
 
+  def close(self):
+    """Release the test record store of a streaming Indexer. Call once
+       all indices and overview pages are written; the indexed tests
+       are not available afterwards.
+    """
+    if self.store is not None:
+      self.store.close()
+
   def writeIndex(self, format):
     """Write indices into test suite build output through format `format`.
     """
@@ -199,17 +553,20 @@ class Indexer:
     data['isXML']      = format.indexExt.startswith('.x')
     data['formatdir']  = format.formatDirName
     data['extmap']     = format.extMap
-    data['tests']      = self.alltests
+    data['tests']      = self._allTests()
     data['suites']     = self.suites
     data['flagInfo']   = self.flags
 
     # Generate indices:
 
     # Reftest indices
+    formatClass = format.__class__.__name__
+    data['tests'] = self._allTests(reftestsOnly=True)
     self.__writeTemplate('reftest-toc.tmpl', data,
-                         format.dest('reftest-toc%s' % format.indexExt))
+                         format.dest('reftest-toc%s' % format.indexExt), formatClass)
+    data['tests'] = self._allTests()
     self.__writeTemplate('reftest.tmpl', data,
-                         format.dest('reftest.list'))
+                         format.dest('reftest.list'), formatClass)
 
     # Table of Contents
     sectionlist = sorted(self.sections.values())
@@ -226,14 +583,17 @@ class Indexer:
           chap.testcount = 0
           chap.testnames = set()
           chapters.append(chap)
-        chap.testnames.update([test['name'] for test in section.tests])
+        if self.store:
+          chap.testnames.update(self.store.sectionTestNames(self._normalizeScheme(section.uri)))
+        else:
+          chap.testnames.update([test['name'] for test in section.tests])
         chap.testcount = len(chap.testnames)
         chap.sections.append(section)
 
       # Generate main toc
       data['chapters'] = chapters
       self.__writeTemplate('chapter-toc.tmpl', data,
-                           format.dest('toc%s' % format.indexExt))
+                           format.dest('toc%s' % format.indexExt), formatClass)
       del data['chapters']
 
       # Generate chapter tocs
@@ -241,11 +601,15 @@ class Indexer:
         data['chaptertitle'] = chap.title
         data['testcount']    = chap.testcount
         data['sections']     = chap.sections
+        self._loadSections(chap.sections)
         self.__writeTemplate('test-toc.tmpl', data, format.dest('chapter-%s%s' \
-                             % (chap.numstr, format.indexExt)))
+                             % (chap.numstr, format.indexExt)), formatClass)
+        self._unloadSections(chap.sections)
 
     else: # not splitChapter
       data['chapters'] = sectionlist
+      self._loadSections(sectionlist)   # single page index needs all sections at once
       self.__writeTemplate('test-toc.tmpl', data,
-                           format.dest('toc%s' % format.indexExt))
+                           format.dest('toc%s' % format.indexExt), formatClass)
+      self._unloadSections(sectionlist)
       del data['chapters']
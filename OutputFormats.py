@@ -5,8 +5,22 @@
 
 import re
 import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import Queue
+import Utils
+import BuildProfile
 from os.path import join, exists, splitext, dirname, basename
 from Sources import XHTMLSource, HTMLSource, SVGSource, SourceTree
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 class ExtensionMap:
   """ Given a file extension mapping (e.g. {'.xht' : '.htm'}), provides
@@ -21,6 +35,262 @@ class ExtensionMap:
         return splitext(path)[0] + self.extMap[ext]
     return path
 
+class BuildManifest:
+  """Record of the files produced by a build and a digest of the inputs
+     each one was built from, kept in the build root between builds.
+     Used for incremental rebuilds: outputs whose digest is unchanged can be
+     skipped, and outputs recorded by the previous build but not by this
+     one are deleted by close().
+  """
+  fileName = '.buildmanifest'
+
+  def __init__(self, root):
+    self.root = root
+    self.path = join(root, self.fileName)
+    self.previous = {}
+    if exists(self.path):
+      try:
+        with open(self.path) as f:
+          self.previous = json.load(f)
+      except ValueError:
+        pass
+    self.current = {}
+
+  def _key(self, path):
+    return Utils.relpath(path, self.root)
+
+  def isCurrent(self, path, digest):
+    """Returns True if file `path` exists and was built by the previous
+       build from inputs with digest `digest`.
+    """
+    return (self.previous.get(self._key(path)) == digest) and exists(path)
+
+  def record(self, path, digest):
+    """Record that this build produced file `path` from inputs with
+       digest `digest`.
+    """
+    self.current[self._key(path)] = digest
+
+  def update(self, entries):
+    """Add `entries` recorded by another copy of this manifest."""
+    self.current.update(entries)
+
+  def copyTree(self, src, dest, excludeDirs = (), copy = Utils.copyFile):
+    """Copy directory tree `src` into `dest`, skipping files whose source
+       has not changed since the previous build and directories named in
+       `excludeDirs`. Files are copied with function `copy`.
+    """
+    for root, dirs, files in os.walk(src):
+      for dir in excludeDirs:
+        if dir in dirs:
+          dirs.remove(dir)
+      destDir = join(dest, Utils.relpath(root, src))
+      if not exists(destDir):
+        os.makedirs(destDir)
+      for name in files:
+        srcPath = join(root, name)
+        destPath = join(destDir, name)
+        digest = Utils.fileDigest(srcPath).encode('hex')
+        if not self.isCurrent(destPath, digest):
+          copy(srcPath, destPath)
+        self.record(destPath, digest)
+
+  def close(self):
+    """Delete outputs of the previous build that this build did not
+       produce and save the manifest.
+    """
+    for key in self.previous:
+      if key not in self.current:
+        path = join(self.root, key)
+        if exists(path):
+          os.remove(path)
+    fd, tempPath = tempfile.mkstemp(dir = self.root)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(self.current, f, indent = 0, sort_keys = True)
+    os.chmod(tempPath, 0644)
+    os.rename(tempPath, self.path)
+    self.previous = self.current
+    self.current = {}
+
+
+class BlobStore:
+  """Content-addressed store of output files, kept in the build root.
+     Each distinct file content is stored once, as a blob named by its
+     SHA-1 digest; outputs are hard links to their blob, or reflinks or
+     copies where hard links are not supported. Hard linked outputs share
+     their data and must be replaced rather than modified in place.
+  """
+  dirName = '.blobs'
+  FICLONE = 0x40049409  # Linux ioctl cloning a file's extents
+
+  def __init__(self, root):
+    self.root = join(root, self.dirName)
+    self.canLink = hasattr(os, 'link')
+    self.canReflink = bool(fcntl)
+    if not exists(self.root):
+      os.makedirs(self.root)
+
+  def _blobPath(self, digest):
+    return join(self.root, digest[:2], digest[2:])
+
+  def _store(self, blobPath, writeBlob):
+    """Create blob `blobPath` by calling `writeBlob` with a temporary
+       path, unless it exists."""
+    if not exists(blobPath):
+      if not exists(dirname(blobPath)):
+        try:
+          os.makedirs(dirname(blobPath))
+        except OSError: # created concurrently
+          pass
+      fd, tempPath = tempfile.mkstemp(dir = dirname(blobPath))
+      os.close(fd)
+      writeBlob(tempPath)
+      os.rename(tempPath, blobPath)
+
+  def _reflink(self, blobPath, destPath):
+    with open(blobPath, 'rb') as src:
+      with open(destPath, 'wb') as dest:
+        fcntl.ioctl(dest.fileno(), self.FICLONE, src.fileno())
+
+  def _place(self, blobPath, destPath):
+    """Make `destPath` a link to, reflink to or copy of `blobPath`."""
+    if exists(destPath):
+      os.remove(destPath)
+    if self.canLink:
+      try:
+        os.link(blobPath, destPath)
+        return
+      except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+          self.canLink = False
+    if self.canReflink:
+      try:
+        self._reflink(blobPath, destPath)
+        return
+      except (IOError, OSError):
+        self.canReflink = False
+    shutil.copy2(blobPath, destPath)
+
+  def copy(self, srcPath, destPath):
+    """Place a copy of file `srcPath` at `destPath`, like shutil.copy2."""
+    blobPath = self._blobPath(Utils.fileDigest(srcPath).encode('hex'))
+    self._store(blobPath, lambda tempPath: shutil.copy2(srcPath, tempPath))
+    self._place(blobPath, destPath)
+
+  def write(self, data, destPath):
+    """Place a file containing byte string `data` at `destPath`."""
+    blobPath = self._blobPath(hashlib.sha1(data).hexdigest())
+    def writeBlob(tempPath):
+      with open(tempPath, 'wb') as f:
+        f.write(data)
+      os.chmod(tempPath, 0644)
+    self._store(blobPath, writeBlob)
+    self._place(blobPath, destPath)
+
+  def close(self):
+    """Delete blobs no output links to anymore."""
+    for root, dirs, files in os.walk(self.root):
+      for name in files:
+        path = join(root, name)
+        if (1 == os.stat(path).st_nlink):
+          os.remove(path)
+
+
+class OutputWriter:
+  """Write-behind pipeline for output files. Writes are queued and done by
+     a pool of `threads` writer threads, so disk I/O overlaps with the
+     serialization of later outputs. Each thread queues at most
+     `maxPending` writes; callers block while its queue is full, which
+     bounds the memory held by pending output. Writes to the same path are
+     done in order. Errors are raised by the next flush() or close().
+
+     Writer threads do not survive a fork, so in a forked child process
+     writes are done directly.
+  """
+  def __init__(self, threads = 4, maxPending = 64):
+    self.pid = os.getpid()
+    self.error = None
+    self.queues = [Queue.Queue(maxPending) for index in range(max(threads, 1))]
+    self.threads = []
+    for queue in self.queues:
+      thread = threading.Thread(target = self._run, args = (queue,), name = 'OutputWriter')
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def _run(self, queue):
+    while True:
+      call = queue.get()
+      try:
+        if call is None:
+          return
+        BuildProfile.setContext(*call[0])
+        call[1](*call[2:])
+      except Exception:
+        if self.error is None:
+          self.error = sys.exc_info()
+      finally:
+        queue.task_done()
+
+  def _isAsync(self):
+    return self.threads and (os.getpid() == self.pid)
+
+  def call(self, path, function, *args):
+    """Call `function(*args)`, which writes file `path`, on a writer thread."""
+    if self._isAsync():
+      # counted in the build profile context of the caller
+      self.queues[hash(path) % len(self.queues)].put((BuildProfile.context(), function) + args)
+    else:
+      function(*args)
+
+  def write(self, path, data):
+    """Atomically replace file `path` with byte string `data`."""
+    self.call(path, Utils.writeFile, path, data)
+
+  def flush(self):
+    """Wait until all queued writes are done."""
+    if self._isAsync():
+      for queue in self.queues:
+        queue.join()
+    if self.error:
+      error, self.error = self.error, None
+      raise error[0], error[1], error[2]
+
+  def close(self):
+    """Finish all queued writes and stop the writer threads."""
+    if self._isAsync():
+      for queue in self.queues:
+        queue.put(None)
+      for thread in self.threads:
+        thread.join()
+    self.threads = []
+    self.flush()
+
+
+def copier(blobStore = None, writeIfChanged = False, writer = None):
+  """Returns a function copying a file to a path, like shutil.copy2 but
+     replacing the destination atomically or placing it through BlobStore
+     `blobStore`. If `writeIfChanged` is True, destinations with the same
+     contents as their source are left untouched. If OutputWriter `writer`
+     is given, copies are done by its writer threads.
+  """
+  copy = blobStore.copy if blobStore else Utils.copyFile
+  if writeIfChanged:
+    def copyIfChanged(srcPath, destPath):
+      if Utils.fileMatches(destPath, os.path.getsize(srcPath), Utils.fileDigest(srcPath)):
+        BuildProfile.count('unchanged')
+      else:
+        copy(srcPath, destPath)
+    fileCopy = copyIfChanged
+  else:
+    fileCopy = copy
+  if not writer:
+    return fileCopy
+  def copyBehind(srcPath, destPath):
+    writer.call(destPath, fileCopy, srcPath, destPath)
+  return copyBehind
+
+
 class BasicFormat:
   """Base class. A Format manages all the conversions and location
      transformations (e.g. subdirectory for all tests in that format)
@@ -31,6 +301,10 @@ class BasicFormat:
   formatDirName = None
   indexExt      = '.htm'
   convert       = True   # XXX hack to supress format conversion in support dirs, need to clean up output code to make this cleaner
+  manifest      = None   # BuildManifest for incremental builds
+  blobStore     = None   # BlobStore for deduplicated outputs
+  writeIfChanged = False # leave outputs with unchanged contents untouched
+  writer        = None   # OutputWriter for write-behind output
 
   def __init__(self, destroot, sourceTree, extMap=None, outputDirName=None):
     """Creates format root of the output tree. `destroot` is the root path
@@ -45,6 +319,8 @@ class BasicFormat:
       os.makedirs(self.root)
     self.extMap = ExtensionMap(extMap or {})
     self.subdir = None
+    self.__dests = {}      # (subdir, convert, relpath) -> destination path
+    self.__madeDirs = set([self.root])  # directories known to exist
 
   def setSubDir(self, name=None):
     """Sets format to write into group subdirectory `name`.
@@ -57,6 +333,10 @@ class BasicFormat:
   def dest(self, relpath):
     """Returns final destination of relpath in this format and ensures that the
        parent directory exists."""
+    key = (self.subdir, self.convert, relpath)
+    dest = self.__dests.get(key)
+    if dest:
+      return dest
     # Translate path
     if (self.convert):
       relpath = self.extMap.translate(relpath)
@@ -67,14 +347,89 @@ class BasicFormat:
            else join(self.root, relpath)
     # Ensure parent
     parent = dirname(dest)
-    if not exists(parent):
-      os.makedirs(parent)
+    if parent not in self.__madeDirs:
+      if not exists(parent):
+        os.makedirs(parent)
+      self.__madeDirs.add(parent)
 
+    self.__dests[key] = dest
     return dest
 
+  def inputDigest(self, source, *extra):
+    """Returns digest of everything the output of `source` depends on."""
+    sha = hashlib.sha1()
+    sha.update('%s:%s:%s:%s' % (self.__class__.__name__, self.convert,
+                                self.dest(source.relpath), source.revision()))
+    for refRelPath in sorted(ref[3].relpath for ref in source.refs.values() if ref[3]):
+      sha.update(':' + refRelPath)
+    for item in extra:
+      sha.update(':%s' % item)
+    return sha.hexdigest()
+
+  def isCurrent(self, source, record=True):
+    """In incremental builds, returns True if the output for `source` is
+       up to date and need not be written. If `record` is True the
+       output is recorded in the build manifest either way.
+    """
+    if not self.manifest:
+      return False
+    dest = self.dest(source.relpath)
+    digest = self.inputDigest(source)
+    current = self.manifest.isCurrent(dest, digest)
+    if record:
+      self.manifest.record(dest, digest)
+    return current
+
+  def writeFile(self, path, data):
+    """Replace file `path` with byte string `data`. Returns False if
+       the write was skipped because the file is unchanged. If the format
+       has a writer the write is only queued, and True is returned.
+    """
+    if self.writer:
+      self.writer.call(path, self._writeFile, path, data)
+      return True
+    return self._writeFile(path, data)
+
+  def _writeFile(self, path, data):
+    if self.writeIfChanged and Utils.fileMatches(path, len(data), hashlib.sha1(data).digest()):
+      BuildProfile.count('unchanged')
+      return False
+    if self.blobStore:
+      self.blobStore.write(data, path)
+    else:
+      Utils.writeFile(path, data)
+    return True
+
+  def openFile(self, path):
+    """Returns a file object for streaming a replacement of file `path`,
+       or None if outputs must be written whole with writeFile().
+    """
+    if self.writeIfChanged or self.blobStore or self.writer:
+      return None
+    return Utils.AtomicFile(path)
+
+  def flush(self):
+    """Wait until the outputs written so far are on disk."""
+    if self.writer:
+      self.writer.flush()
+
+  def copyTree(self, src, dest):
+    """Copy directory tree `src` to `dest`."""
+    with BuildProfile.phase('copy'):
+      self.flush() # `src` may be an output still queued for writing
+      copy = copier(self.blobStore, self.writeIfChanged, self.writer)
+      if self.manifest:
+        self.manifest.copyTree(src, dest, copy = copy)
+      elif self.blobStore or self.writeIfChanged or self.writer:
+        Utils.copyTree(src, dest, copy = copy)
+      else:
+        shutil.copytree(src, dest)
+
   def write(self, source):
     """Write FileSource to destination, following all necessary
        conversion methods."""
+    if self.isCurrent(source):
+      return
     source.write(self, source)
 
   testTransform = False
@@ -95,8 +450,10 @@ class XHTMLFormat(BasicFormat):
     # skip HTMLonly tests
     if hasattr(source, 'hasFlag') and source.hasFlag('HTMLonly'):
       return
+    if self.isCurrent(source):
+      return
     if isinstance(source, HTMLSource) and self.convert:
-      source.write(self, source.serializeXHTML())
+      source.write(self, source.serializeXHTML)
     else:
       source.write(self)
 
@@ -114,8 +471,10 @@ class HTMLFormat(BasicFormat):
     # skip nonHTML tests
     if hasattr(source, 'hasFlag') and source.hasFlag('nonHTML'):
       return
+    if self.isCurrent(source):
+      return
     if isinstance(source, XHTMLSource) and self.convert:
-      source.write(self, source.serializeHTML())
+      source.write(self, source.serializeHTML)
     else:
       source.write(self)
       
@@ -128,8 +487,10 @@ class HTML5Format(HTMLFormat):
     # skip nonHTML tests
     if hasattr(source, 'hasFlag') and source.hasFlag('nonHTML'):
       return
+    if self.isCurrent(source):
+      return
     if isinstance(source, XHTMLSource) and self.convert:
-      source.write(self, source.serializeHTML())
+      source.write(self, source.serializeHTML)
     else:
       source.write(self)
 
@@ -142,7 +503,7 @@ class SVGFormat(BasicFormat):
 
   def write(self, source):
     # skip non SVG tests
-    if isinstance(source, SVGSource):
+    if isinstance(source, SVGSource) and not self.isCurrent(source):
       source.write(self)
 
 
@@ -159,11 +520,16 @@ class XHTMLPrintFormat(XHTMLFormat):
 
   def write(self, source):
     if (isinstance(source, XHTMLSource)):
-      if not source.hasFlag('HTMLonly'):
-        source.write(self, self.testTransform(source))
+      if not source.hasFlag('HTMLonly') and not self.isCurrent(source):
+        with BuildProfile.phase('serialize', source):
+          output = self.testTransform(source)
+        source.write(self, output)
     else:
       XHTMLFormat.write(self, source)
 
+  def inputDigest(self, source, *extra):
+    return XHTMLFormat.inputDigest(self, source, self.testSuiteName, *extra)
+
   def testTransform(self, source):
     assert isinstance(source, XHTMLSource)
     output = source.serializeXHTML('xhtml10')
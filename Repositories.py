@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+# Repository backends for SourceTree. A backend knows the root of the
+# test repository checkout and which files in it are tracked. Backends
+# do no work until asked, so opening one costs a few stats at most.
+
+import os
+import subprocess
+from os.path import join, abspath, dirname
+from Utils import relpath
+
+class FileSystemRepository(object):
+  """Repository backend for a plain directory tree, all files in which
+     count as tracked.
+  """
+  kind = 'fs'
+  metadataDirs = ('.git', '.hg', '.svn', 'CVS')   # never listed
+
+  def __init__(self, root = '.'):
+    self.root = root
+    self.mFiles = None
+
+  def _listFiles(self):
+    """Returns the list of tracked file paths, relative to the root."""
+    files = []
+    for dir, dirs, fileNames in os.walk(self.root):
+      dirs[:] = [name for name in dirs if name not in self.metadataDirs]
+      base = relpath(dir, self.root)
+      base = '' if (os.curdir == base) else base.replace(os.sep, '/') + '/'
+      files.extend([base + name for name in fileNames])
+    return files
+
+  def files(self):
+    """Returns the frozenset of tracked file paths, relative to the root
+       and with '/' separators. The list is read once, on first use.
+    """
+    if (self.mFiles is None):
+      self.mFiles = frozenset(self._listFiles())
+    return self.mFiles
+
+  def isTracked(self, path):
+    """Returns True if file `path` (relative to the current directory)
+       is tracked by the repository."""
+    return relpath(path, self.root).replace(os.sep, '/') in self.files()
+
+class GitRepository(FileSystemRepository):
+  """Repository backend for a git checkout. Tracked files are listed in
+     bulk by a single `git ls-files`.
+  """
+  kind = 'git'
+
+  def _listFiles(self):
+    git = subprocess.Popen(['git', 'ls-files', '-z'], cwd = self.root,
+                           stdout = subprocess.PIPE)
+    output = git.communicate()[0]
+    if (git.returncode):
+      raise OSError("git ls-files failed in %s" % self.root)
+    return [path for path in output.split('\0') if path]
+
+class MercurialRepository(FileSystemRepository):
+  """Repository backend for a Mercurial checkout. Mercurial is only
+     imported, and the repository opened, when first needed.
+  """
+  kind = 'hg'
+
+  def __init__(self, root = '.'):
+    FileSystemRepository.__init__(self, root)
+    self.mRepo = None
+
+  def repo(self):
+    """Returns the mercurial repository object."""
+    if (self.mRepo is None):
+      from mercurial import ui, hg
+      self.mRepo = hg.repository(ui.ui(), self.root)
+    return self.mRepo
+
+  def _listFiles(self):
+    return list(self.repo()[None].manifest())
+
+# backends by their checkout's metadata directory, in order of preference
+backends = (('.git', GitRepository), ('.hg', MercurialRepository))
+
+def openRepository(path = '.'):
+  """Returns a backend for the repository checkout containing directory
+     `path`, or a FileSystemRepository for `path` if there is none.
+  """
+  root = abspath(path)
+  while True:
+    for metadataDir, backend in backends:
+      if os.path.exists(join(root, metadataDir)):
+        return backend(root if (abspath(path) != root) else path)
+    parent = dirname(root)
+    if (parent == root):
+      return FileSystemRepository(path)
+    root = parent
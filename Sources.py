@@ -5,31 +5,306 @@
 
 from os.path import basename, exists, join
 import os
-import filecmp
 import shutil
 import re
 import codecs
 import collections
 from xml import dom
 import html5lib
-from html5lib import treebuilders, inputstream
+from html5lib import treebuilders
+try:
+  import html5_parser
+  from html5_parser.encoding_parser import codec_name, ContentAttrParser, EncodingBytes
+except (ImportError, RuntimeError): # RuntimeError if built against another libxml2 than lxml
+  html5_parser = None
 from lxml import etree
 from lxml.etree import ParseError
-from Utils import getMimeFromExt, escapeToNamedASCII, basepath, isPathInsideBase, relativeURL, assetName
+from Utils import getMimeFromExt, escapeToNamedASCII, basepath, isPathInsideBase, relativeURL, assetName, fileDigest, listfiles
 import HTMLSerializer
+import BuildProfile
 import warnings
 import hashlib
+import json
+import tempfile
+import marshal
+import stat as statmodule
+from StringIO import StringIO
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+class PathInfo(object):
+  """Classification of a path by a SourceTree, see SourceTree.pathInfo."""
+  __slots__ = ('pathList', 'fileName', 'isIgnored', 'isReference', 'isTestCase', 'isTool', 'assetType', 'assetName')
+
+  def __init__(self, pathList, fileName, isIgnored, isReference, isTestCase, isTool, assetType):
+    self.pathList = pathList
+    self.fileName = fileName
+    self.isIgnored = isIgnored
+    self.isReference = isReference
+    self.isTestCase = isTestCase
+    self.isTool = isTool
+    self.assetType = assetType
+    self.assetName = None   # computed on demand
+
+
+class FileIndex(object):
+  """Index of the files and directories below directory `root`, built
+     with one listing per directory on first use. File paths below the
+     root map to (size, mtime); paths outside it are looked up on the
+     filesystem. Version control metadata directories are not indexed.
+
+     If `cachePath` is given, the index is persisted there; later builds
+     rescan only the directories whose mtimes changed. Files edited in
+     place do not change their directory's mtime, so only the names of
+     files are persisted: the sizes and mtimes of files in reused
+     directories are read from the files themselves on first use.
+  """
+  version = 2   # bump whenever the persisted format changes
+  skipDirs = frozenset(('.git', '.hg', '.svn', 'CVS'))
+
+  def __init__(self, root = '.', cachePath = None):
+    self.root = root
+    self.cachePath = cachePath
+    self.mDirs = None   # directory key -> (mtime, {file name: (size, mtime) or None if not read yet}, [subdirectory names])
+
+  def _key(self, path):
+    """Returns the index key of `path`, None if it is outside the root."""
+    key = os.path.normpath(os.path.relpath(path, self.root))
+    if (key.startswith(os.pardir) and ((os.pardir == key) or key.startswith(os.pardir + os.sep))):
+      return None
+    return key
+
+  def _listDir(self, path):
+    """Returns ({file name: (size, mtime)}, [subdirectory names]) of directory `path`."""
+    files = {}
+    dirs = []
+    if (scandir):
+      for entry in scandir(path):
+        if (entry.is_dir()):
+          if (entry.name not in self.skipDirs):
+            dirs.append(entry.name)
+        else:
+          try:
+            stat = entry.stat()
+          except OSError: # dangling link
+            stat = entry.stat(follow_symlinks = False)
+          files[entry.name] = (stat.st_size, stat.st_mtime)
+    else:
+      for name in os.listdir(path):
+        try:
+          stat = os.stat(join(path, name))
+        except OSError: # dangling link
+          stat = os.lstat(join(path, name))
+        if (statmodule.S_ISDIR(stat.st_mode)):
+          if (name not in self.skipDirs):
+            dirs.append(name)
+        else:
+          files[name] = (stat.st_size, stat.st_mtime)
+    dirs.sort()
+    return (files, dirs)
+
+  def _scan(self, key, previous, dirs, ancestors):
+    """Index directory `key` into `dirs`, reusing the entries of index
+       `previous` if the directory did not change. Returns the number of
+       directories listed.
+    """
+    path = self.root if ('.' == key) else join(self.root, key)
+    try:
+      stat = os.stat(path)
+    except OSError: # removed while scanning
+      return 0
+    if ((stat.st_dev, stat.st_ino) in ancestors): # symlink cycle
+      return 0
+    listed = 0
+    entry = previous.get(key)
+    if ((not entry) or (entry[0] != stat.st_mtime)):
+      entry = (stat.st_mtime,) + self._listDir(path)
+      listed = 1
+    dirs[key] = entry
+    ancestors = ancestors | frozenset(((stat.st_dev, stat.st_ino),))
+    for name in entry[2]:
+      listed += self._scan(name if ('.' == key) else join(key, name), previous, dirs, ancestors)
+    return listed
+
+  def _load(self):
+    try:
+      with open(self.cachePath, 'rb') as f:
+        record = marshal.load(f)
+      if ((self.version, os.path.abspath(self.root)) == record[:2]):
+        return record[2]
+    except (IOError, EOFError, ValueError, TypeError):
+      pass
+    return {}
+
+  def _save(self):
+    cacheDir = basepath(self.cachePath) or '.'
+    if not exists(cacheDir):
+      os.makedirs(cacheDir)
+    fd, tempPath = tempfile.mkstemp(dir = cacheDir)
+    dirs = dict((key, (entry[0], dict.fromkeys(entry[1]), entry[2]))
+                for key, entry in self.mDirs.iteritems())
+    with os.fdopen(fd, 'wb') as f:
+      marshal.dump((self.version, os.path.abspath(self.root), dirs), f)
+    os.rename(tempPath, self.cachePath)
+
+  def refresh(self):
+    """Rescan the directories that changed since the index was built or
+       loaded, and persist the result if it changed.
+    """
+    previous = self.mDirs
+    if (previous is None):
+      previous = self._load() if (self.cachePath) else {}
+    dirs = {}
+    listed = self._scan('.', previous, dirs, frozenset())
+    self.mDirs = dirs
+    if (self.cachePath and (listed or (len(dirs) != len(previous)))):
+      self._save()
+
+  def _dirs(self):
+    if (self.mDirs is None):
+      self.refresh()
+    return self.mDirs
+
+  def _lookup(self, path):
+    """Returns (key, directory entry of `path` or None, files of the
+       directory containing file `path` or None), or None if `path` is
+       outside the root."""
+    key = self._key(path)
+    if (key is None):
+      return None
+    dirs = self._dirs()
+    if (key in dirs):
+      return (key, dirs[key], None)
+    dirKey, name = os.path.split(key)
+    entry = dirs.get(dirKey or '.')
+    return (key, None, entry[1] if (entry and (name in entry[1])) else None)
+
+  def exists(self, path):
+    found = self._lookup(path)
+    if (found is None):
+      return exists(path)
+    return bool(found[1] or (found[2] is not None))
+
+  def isdir(self, path):
+    found = self._lookup(path)
+    if (found is None):
+      return os.path.isdir(path)
+    return bool(found[1])
+
+  def stat(self, path):
+    """Returns (size, mtime) of file `path`, or None if it does not exist."""
+    found = self._lookup(path)
+    if (found is None):
+      if not os.path.isfile(path):
+        return None
+      stat = os.stat(path)
+      return (stat.st_size, stat.st_mtime)
+    files = found[2]
+    if (files is None):
+      return None
+    name = os.path.basename(found[0])
+    if (files[name] is None): # persisted entry, read the file's own stat
+      try:
+        stat = os.stat(path)
+      except OSError: # removed since listed
+        return None
+      files[name] = (stat.st_size, stat.st_mtime)
+    return files[name]
+
+  def listFiles(self, dir, ext = None):
+    """Returns the sorted names of the files in directory `dir`,
+       only those ending in `ext` if given. See Utils.listfiles.
+    """
+    found = self._lookup(dir)
+    if (found is None):
+      return sorted(listfiles(dir, ext))
+    if (not found[1]):
+      return []
+    return sorted([name for name in found[1][1] if ((not ext) or name.endswith(ext))])
+
+  def walk(self, top, excludeDirs = ()):
+    """Walk directory `top` like os.walk, yielding (dirpath, dirnames,
+       filenames) top down; the subdirectories named in `excludeDirs`,
+       or removed from dirnames by the caller, are not walked.
+    """
+    found = self._lookup(top)
+    if (found is None):
+      for root, dirs, files in os.walk(top):
+        dirs[:] = sorted(dir for dir in dirs if (dir not in excludeDirs))
+        yield (root, dirs, sorted(files))
+      return
+    if (not found[1]):
+      return
+    dirs = self._dirs()
+    stack = [(top, found[0])]
+    while stack:
+      path, key = stack.pop()
+      entry = dirs.get(key)
+      if (not entry): # not indexed, see _scan
+        continue
+      subdirs = [name for name in entry[2] if (name not in excludeDirs)]
+      yield (path, subdirs, sorted(entry[1]))
+      for name in reversed(subdirs):
+        stack.append((join(path, name), name if ('.' == key) else join(key, name)))
 
 class SourceTree(object):
   """Class that manages structure of test repository source.
      Temporarily hard-coded path and filename rules, this should be configurable.
   """
 
-  def __init__(self, repository = None):
+  maxCachedPaths = 100000   # bound on the number of memoized path classifications
+
+  refNamePrefixRE = re.compile('(^ref-|^notref-).+')
+  refNameSuffixRE = re.compile('.+(-ref[0-9]*$|-notref[0-9]*$)')
+
+  def __init__(self, repository = None, fileIndex = None):
+    """`fileIndex` is an optional FileIndex answering the file system
+       queries below instead of the file system itself.
+    """
     self.mTestExtensions = ['.xht', '.html', '.xhtml', '.htm', '.xml', '.svg']
     self.mReferenceExtensions = ['.xht', '.html', '.xhtml', '.htm', '.xml', '.png', '.svg']
     self.mRepository = repository
-  
+    self.mFileIndex = fileIndex
+    self.mPathInfo = {}
+
+  def exists(self, path):
+    return self.mFileIndex.exists(path) if (self.mFileIndex) else exists(path)
+
+  def listFiles(self, dir, ext = None):
+    """Returns the names of the files in directory `dir`, see Utils.listfiles."""
+    return self.mFileIndex.listFiles(dir, ext) if (self.mFileIndex) else listfiles(dir, ext)
+
+  def walk(self, top, excludeDirs = ()):
+    """Walk directory `top` like os.walk, skipping the subdirectories
+       named in `excludeDirs`.
+    """
+    if (self.mFileIndex):
+      return self.mFileIndex.walk(top, excludeDirs)
+    return self._walk(top, excludeDirs)
+
+  @staticmethod
+  def _walk(top, excludeDirs):
+    for root, dirs, files in os.walk(top):
+      for dir in excludeDirs:
+        if dir in dirs:
+          dirs.remove(dir)
+      yield (root, dirs, files)
+
+  def repository(self):
+    """Returns the repository backend (see Repositories), or None."""
+    return self.mRepository
+
+  def isVersioned(self, filePath):
+    """Returns True if the repository tracks file `filePath`. Without a
+       repository backend all files count as versioned.
+    """
+    return self.mRepository.isTracked(filePath) if (self.mRepository) else True
+
   def _splitDirs(self, dir):
     if ('' == dir):
       pathList = []
@@ -46,17 +321,39 @@ class SourceTree(object):
     """
     dir, fileName = os.path.split(filePath.lower())
     return (self._splitDirs(dir), fileName)
+
+  def pathInfo(self, filePath):
+    """Returns the memoized PathInfo classification of `filePath`."""
+    info = self.mPathInfo.get(filePath)
+    if (info is None):
+      pathList, fileName = self._splitPath(filePath)
+      isReference = self._isReference(pathList, fileName)
+      isTestCase = self._isTestCase(pathList, fileName)
+      isTool = self._isTool(pathList, fileName)
+      if (isReference):
+        assetType = intern('reference')
+      elif (isTestCase):
+        assetType = intern('testcase')
+      elif (isTool):
+        assetType = intern('tool')
+      else:
+        assetType = intern('support')
+      info = PathInfo(pathList, fileName, self._isIgnored(pathList, fileName),
+                      isReference, isTestCase, isTool, assetType)
+      if (self.maxCachedPaths <= len(self.mPathInfo)):
+        self.mPathInfo.clear()
+      self.mPathInfo[filePath] = info
+    return info
       
   def isTracked(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName))
+    return (not self.pathInfo(filePath).isIgnored)
       
   def _isApprovedPath(self, pathList):
     return ((1 < len(pathList)) and ('approved' == pathList[0]) and (('support' == pathList[1]) or ('src' in pathList)))
       
   def isApprovedPath(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName)) and self._isApprovedPath(pathList)
+    info = self.pathInfo(filePath)
+    return (not info.isIgnored) and self._isApprovedPath(info.pathList)
 
   def _isIgnoredPath(self, pathList):
       return (('.hg' in pathList) or ('.git' in pathList) or
@@ -76,8 +373,7 @@ class SourceTree(object):
     return True
       
   def isIgnored(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return self._isIgnored(pathList, fileName)
+    return self.pathInfo(filePath).isIgnored
   
   def isIgnoredDir(self, dir):
     pathList = self._splitDirs(dir)
@@ -90,8 +386,8 @@ class SourceTree(object):
     return self._isToolPath(pathList)
   
   def isTool(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName)) and self._isTool(pathList, fileName)
+    info = self.pathInfo(filePath)
+    return (not info.isIgnored) and info.isTool
 
   def _isSupportPath(self, pathList):
     return ('support' in pathList)
@@ -103,8 +399,9 @@ class SourceTree(object):
              (not self._isTestCase(pathList, fileName))))
       
   def isSupport(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName)) and self._isSupport(pathList, fileName)
+    info = self.pathInfo(filePath)
+    return (not info.isIgnored) and (self._isSupportPath(info.pathList) or
+                                     not (info.isTool or info.isReference or info.isTestCase))
       
   def _isReferencePath(self, pathList):
     return (('reftest' in pathList) or ('reference' in pathList))
@@ -112,8 +409,8 @@ class SourceTree(object):
   def _isReference(self, pathList, fileName):
     if ((not self._isSupportPath(pathList)) and (not self._isToolPath(pathList))):
       baseName, fileExt = os.path.splitext(fileName)[:2]
-      if (bool(re.search('(^ref-|^notref-).+', baseName)) or 
-          bool(re.search('.+(-ref[0-9]*$|-notref[0-9]*$)', baseName)) or 
+      if (bool(self.refNamePrefixRE.search(baseName)) or 
+          bool(self.refNameSuffixRE.search(baseName)) or 
           ('-ref-' in baseName) or ('-notref-' in baseName)):
         return (fileExt in self.mReferenceExtensions)
       if (self._isReferencePath(pathList)):
@@ -121,12 +418,11 @@ class SourceTree(object):
     return False    
       
   def isReference(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName)) and self._isReference(pathList, fileName)
+    info = self.pathInfo(filePath)
+    return (not info.isIgnored) and info.isReference
   
   def isReferenceAnywhere(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return self._isReference(pathList, fileName)
+    return self.pathInfo(filePath).isReference
   
   def _isTestCase(self, pathList, fileName):
     if ((not self._isToolPath(pathList)) and (not self._isSupportPath(pathList)) and (not self._isReference(pathList, fileName))):
@@ -135,33 +431,344 @@ class SourceTree(object):
     return False
 
   def isTestCase(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    return (not self._isIgnored(pathList, fileName)) and self._isTestCase(pathList, fileName)
+    """Returns True if `filePath` is a test, i.e. classified as one by
+       its path and tracked by the repository (see isVersioned).
+    """
+    info = self.pathInfo(filePath)
+    return (not info.isIgnored) and info.isTestCase and self.isVersioned(filePath)
       
   def getAssetName(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    if (self._isReference(pathList, fileName) or self._isTestCase(pathList, fileName)):
-      return assetName(fileName)
-    return fileName.lower() # support files keep full name
+    info = self.pathInfo(filePath)
+    if (info.assetName is None):
+      if (info.isReference or info.isTestCase):
+        info.assetName = assetName(info.fileName)
+      else:
+        info.assetName = info.fileName # support files keep full name
+    return info.assetName
 
   def getAssetType(self, filePath):
-    pathList, fileName = self._splitPath(filePath)
-    if (self._isReference(pathList, fileName)):
-      return intern('reference')
-    if (self._isTestCase(pathList, fileName)):
-      return intern('testcase')
-    if (self._isTool(pathList, fileName)):
-      return intern('tool')
-    return intern('support')
+    return self.pathInfo(filePath).assetType
   
 
+class ParseCache:
+  """Persistent on-disk cache of the metadata, references, scripts and
+     errors extracted from parsed sources. Entries are keyed by the SHA-1
+     of the file contents, the source path, the source class, the HTML
+     parser backend and the cache format `version`, so changed files are
+     simply never looked up again.
+     Reference names and paths depend on the location of the source, so
+     copies of a file in different directories have separate entries.
+     Only the results of full parses are stored; metadata scans
+     (SourceCache scanMetadata) read the cache but never write to it,
+     so entries are valid in either mode.
+  """
+  version = 1   # bump whenever parsing or metadata extraction changes
+
+  def __init__(self, cacheDir):
+    self.cacheDir = cacheDir
+    if not exists(cacheDir):
+      os.makedirs(cacheDir)
+
+  def _cachePath(self, source):
+    sha = hashlib.sha1()
+    parser = getattr(source, 'htmlParser', None) # backends recover errors differently
+    sha.update('%s:%s:%s:%s:' % (self.version, source.__class__.__name__,
+                                 parser.name if parser else '',
+                                 os.path.normpath(source.sourcepath)))
+    sha.update(source.contentDigest())
+    digest = sha.hexdigest()
+    return join(self.cacheDir, digest[:2], digest[2:] + '.json')
+
+  @staticmethod
+  def _dumpString(string):
+    return [string, string.line] if hasattr(string, 'line') else [string]
+
+  @staticmethod
+  def _loadString(record, encoding = None):
+    string = record[0].encode(encoding) if encoding else record[0]
+    return LineString(string, record[1]) if (1 < len(record)) else string
+
+  def load(self, source):
+    """Restore parse results of `source` from the cache.
+       Returns False if there is no usable cache entry.
+    """
+    try:
+      with open(self._cachePath(source)) as f:
+        record = json.load(f)
+    except (IOError, ValueError):
+      return False
+    metadata = record['metadata']
+    if (metadata):
+      metadata['credits'] = [tuple(credit) for credit in metadata['credits']]
+      metadata['reviewers'] = [tuple(reviewer) for reviewer in metadata['reviewers']]
+      metadata['links'] = [self._loadString(link) for link in metadata['links']]
+    source.metadata = metadata
+    source.encoding = record['encoding'].encode('ascii')
+    source.refs = dict((name, (refType, refPath, None, None)) for name, refType, refPath in record['refs'])
+    source.scripts = dict((src, None) for src in record['scripts'])
+    errors = record['errors']
+    source.errors = [self._loadString(error, 'utf-8') for error in errors] if (errors is not None) else None
+    source.refsChanged()
+    return True
+
+  def store(self, source):
+    """Save parse results of `source` into the cache."""
+    metadata = None
+    if (source.metadata):
+      metadata = dict(source.metadata)
+      metadata['links'] = [self._dumpString(link) for link in metadata['links']]
+    record = {'metadata': metadata,
+              'encoding': source.encoding,
+              'refs'    : [(name, ref[0], ref[1]) for name, ref in source.refs.items()],
+              'scripts' : source.scripts.keys(),
+              'errors'  : [self._dumpString(error) for error in source.errors] if (source.errors is not None) else None
+             }
+    path = self._cachePath(source)
+    if not exists(basepath(path)):
+      os.makedirs(basepath(path))
+    fd, tempPath = tempfile.mkstemp(dir = basepath(path))
+    with os.fdopen(fd, 'w') as f:
+      json.dump(record, f)
+    os.rename(tempPath, path)
+
+
+class TreeCache:
+  """Bounds the number of sources that keep their parsed tree in memory.
+     When more than `maxTrees` sources hold a tree, the least recently used
+     ones are compacted; their trees are reparsed on demand.
+  """
+  def __init__(self, maxTrees):
+    self.maxTrees = max(1, maxTrees)
+    self.sources = collections.OrderedDict() # id -> source, oldest first
+
+  def touch(self, source):
+    """Mark the tree of `source` as most recently used."""
+    self.sources.pop(id(source), None)
+    self.sources[id(source)] = source
+    while (self.maxTrees < len(self.sources)):
+      oldest = self.sources.popitem(last = False)[1]
+      oldest.compact()
+
+  def discard(self, source):
+    self.sources.pop(id(source), None)
+
+
+class ReferenceWalk(object):
+  """Depth-first walk of the references reachable from a source."""
+  __slots__ = ('sources', 'paths', 'exact', 'cycles')
+
+  def __init__(self):
+    self.sources = []    # reachable sources in preorder
+    self.paths = set()   # paths of all reachable references
+    self.exact = True    # False if any reference has no FileSource
+    self.cycles = []     # lists of sourcepaths, each leading back to its first
+
+
+class ReferenceGraph:
+  """Graph of the references between the sources of a suite: nodes are
+     FileSources, edges their == and != references. Reference resolution
+     is done once per source; closures, reference chains and revisions are
+     memoized until any edge changes (see FileSource.refsChanged).
+  """
+  # Format of the revision ids from revision(), bumped whenever their
+  # computation changes so consumers of stored revisions can tell. It is
+  # written at the top of testinfo.data and the implementation report.
+  # 1: SHA-1 of the serialized source and references, in reference order
+  # 2: SHA-1 of the content digests of the source and its references,
+  #    in order of their paths
+  revisionFormat = 2
+
+  def __init__(self):
+    self.resolved = {}   # id -> source whose reference paths were resolved
+    self.reported = set()
+    self.refsGeneration = 0   # bumped on any change to the references of a source
+    self.edgesGeneration = 0  # bumped when the targets or types of references change
+    self.generation = None
+    self._reset()
+
+  def changed(self, edges = True):
+    """Invalidate memoized results after a change to the references of
+       a source in the graph. `edges` is False if only reference paths
+       changed."""
+    self.refsGeneration += 1
+    if (edges):
+      self.edgesGeneration += 1
+
+  def _reset(self):
+    self.generation = self.edgesGeneration
+    self._walks = {}      # (id, includeSelf) -> (source, ReferenceWalk)
+    self._chains = {}     # id -> (source, chains, paths added to seen)
+    self._revisions = {}  # id -> (source, revision)
+
+  def _check(self):
+    if (self.generation != self.edgesGeneration):
+      self._reset()
+
+  def _refPath(self, source, refRelPath, refSource):
+    if (refSource):
+      return refSource.sourcepath
+    return os.path.normpath(join(basepath(source.sourcepath), refRelPath))
+
+  def resolve(self, source, sourceCache, ui = None):
+    """Generate the sources referenced by `source` through SourceCache
+       `sourceCache` and link them as its references, transitively.
+       Missing reference files are reported through `ui`.
+    """
+    if (id(source) in self.resolved):
+      return
+    self.resolved[id(source)] = source
+    for refSrcPath, refRelPath, refType in source.getReferencePaths():
+      if (sourceCache.sourceTree.exists(refSrcPath)):
+        ref = sourceCache.generateSource(refSrcPath, refRelPath)
+        source.addReference(ref)
+        self.resolve(ref, sourceCache, ui)
+      elif (ui):
+        ui.warn("Missing Reference file: ", refSrcPath, "\n  referenced from: ", source.sourcepath, "\n")
+
+  def walk(self, source, includeSelf = False):
+    """Returns the ReferenceWalk from `source`. The source itself is listed
+       only if `includeSelf` is True and a reference cycle leads back to it.
+    """
+    self._check()
+    key = (id(source), includeSelf)
+    if (key in self._walks):
+      return self._walks[key][1]
+    walk = ReferenceWalk()
+    seen = set() if includeSelf else set([id(source)])
+    stack = []
+    def visit(node):
+      stack.append(node)
+      for refName, (refType, refRelPath, refNode, refSource) in node.refs.items():
+        walk.paths.add(self._refPath(node, refRelPath, refSource))
+        if (not refSource):
+          walk.exact = False
+          continue
+        for index, ancestor in enumerate(stack):
+          if (ancestor is refSource):
+            walk.cycles.append([ref.sourcepath for ref in stack[index:]])
+            break
+        if (id(refSource) not in seen):
+          seen.add(id(refSource))
+          walk.sources.append(refSource)
+          visit(refSource)
+      stack.pop()
+    visit(source)
+    self._walks[key] = (source, walk)
+    return walk
+
+  def closure(self, source):
+    """Returns all sources transitively referenced by `source`, except
+       itself, in depth-first order.
+    """
+    return self.walk(source).sources
+
+  def reportCycles(self, source, ui):
+    """Report reference cycles reachable from `source` through `ui`,
+       each one once.
+    """
+    for cycle in self.walk(source).cycles:
+      key = frozenset(cycle)
+      if (key not in self.reported):
+        self.reported.add(key)
+        ui.note("Reference cycle: ", ' -> '.join(cycle + cycle[:1]), "\n")
+
+  def revision(self, source):
+    """Returns hash of the contents of `source` and of all sources it
+       references transitively, in order of their paths so the hash does
+       not depend on the order references were added in. The source is
+       hashed again if a reference cycle leads back to it.
+    """
+    self._check()
+    memo = self._revisions.get(id(source))
+    if (memo is None):
+      sha = hashlib.sha1()
+      sha.update(source.contentDigest())
+      for refSource in sorted(self.walk(source, True).sources, key = lambda ref: ref.sourcepath):
+        sha.update(refSource.contentDigest())
+      memo = self._revisions[id(source)] = (source, sha.hexdigest())
+    return memo[1]
+
+  def chains(self, source):
+    """Returns the reference chains of `source`, a list of lists of
+       (name, repopath, parent, refName, refType) entries, each standing
+       for reference `refName` of source `parent`. Each chain lists ==
+       references followed by the != references that apply to all chains.
+    """
+    self._check()
+    return self._chainsFrom(source, set([source.sourcepath]))
+
+  def _chainsFrom(self, source, seen):
+    """Chains of `source`, skipping and updating the paths in `seen`."""
+    walk = self.walk(source)
+    if (walk.exact and seen.isdisjoint(walk.paths - set([source.sourcepath]))):
+      # no reference path is skipped, the canonical result applies
+      memo = self._chains.get(id(source))
+      if (memo is None):
+        canonical = set([source.sourcepath])
+        chains = self._listChains(source, canonical)
+        canonical.discard(source.sourcepath)
+        memo = self._chains[id(source)] = (source, chains, canonical)
+      seen.update(memo[2])
+      return memo[1]
+    return self._listChains(source, seen)
+
+  def _listChains(self, source, seen):
+    sourceTree = source.sourceTree
+    chains = []
+    for refName, (refType, refRelPath, refNode, refSource) in source.refs.items():
+      if ('==' == refType):
+        refSourcePath = self._refPath(source, refRelPath, refSource)
+        if (refSourcePath in seen):
+          continue
+        seen.add(refSourcePath)
+        entry = (sourceTree.getAssetName(refSourcePath), refSourcePath, source, refName, refType)
+        subChains = self._chainsFrom(refSource, seen.copy()) if (refSource and refSource.refs) else None
+        if (subChains):
+          for subChain in subChains:
+            chains.append([entry] + subChain)
+        else:
+          chains.append([entry])
+    notRefs = {}
+    for refName, (refType, refRelPath, refNode, refSource) in source.refs.items():
+      if ('!=' == refType):
+        refSourcePath = self._refPath(source, refRelPath, refSource)
+        if (refSourcePath in seen):
+          continue
+        seen.add(refSourcePath)
+        name = sourceTree.getAssetName(refSourcePath)
+        notRefs[name] = (name, refSourcePath, source, refName, '!=')
+        if (refSource and refSource.refs):
+          for subChain in self._chainsFrom(refSource, seen):
+            for entry in subChain:
+              notRefs[entry[0]] = entry[:4] + ('!=',)
+    if (notRefs):
+      if (chains):
+        for chain in chains:
+          names = set(entry[0] for entry in chain)
+          chain.extend(notRef for notRef in notRefs.values() if (notRef[0] not in names))
+      else:
+        chains.append(notRefs.values())
+    return chains
+
+
 class SourceCache:
   """Cache for FileSource objects. Supports one FileSource object
      per sourcepath.
   """
-  def __init__(self, sourceTree):
+  def __init__(self, sourceTree, parseCacheDir = None, maxTrees = None, scanMetadata = False):
+    """If `parseCacheDir` is given, parse results are persisted there
+       between builds (see ParseCache).
+       If `maxTrees` is given, at most that many parsed trees are kept in
+       memory at once (see TreeCache).
+       If `scanMetadata` is True, XML sources are validated by scanning
+       only their metadata (see XMLSource.scan).
+    """
     self.__cache = {}
     self.sourceTree = sourceTree
+    self.parseCache = ParseCache(parseCacheDir) if parseCacheDir else None
+    self.treeCache = TreeCache(maxTrees) if maxTrees else None
+    self.scanMetadata = scanMetadata
+    self.refGraph = ReferenceGraph()
 
   def generateSource(self, sourcepath, relpath, data = None):
     """Return a FileSource or derivative based on the extensionMap.
@@ -190,7 +797,11 @@ class SourceCache:
       source = XMLSource(self.sourceTree, sourcepath, relpath, data)
     else:
       source = FileSource(self.sourceTree, sourcepath, relpath, mime, data)
+    source.refGraph = self.refGraph
     if (None == data):
+      source.parseCache = self.parseCache
+      source.treeCache = self.treeCache
+      source.scanMetadata = self.scanMetadata
       self.__cache[sourcepath] = source
     return source
 
@@ -271,7 +882,10 @@ class SourceSet:
 
   def adjustContentPaths(self, format):
     for source in self.pathMap.itervalues():
-      source.adjustContentPaths(format)
+      # reference paths are indexed, so only skip sources without references
+      if source.refs or not format.isCurrent(source, record=False):
+        with BuildProfile.phase('adjust', source):
+          source.adjustContentPaths(format)
   
   def write(self, format):
     """Write files out through OutputFormat `format`.
@@ -300,62 +914,95 @@ class StringReader(object):
 
 
 class NamedDict(object):
-    def get(self, key):
-        if (key in self):
-            return self[key]
-        return None
+    """Dictionary-like record with the fixed set of keys `fields`, whose
+       values are kept in attributes of the same names. Subclasses set
+       `fields`, `fieldSet` (the same keys as a frozenset for lookups)
+       and usually `__slots__`. Unknown keys read as None.
+    """
+    __slots__ = ()
+    fields = ()
+    fieldSet = frozenset()
+
+    # Template Toolkit only treats values with a __dict__ as objects, and
+    # applies its hash methods to the __dict__, so it is the record itself
+    @property
+    def __dict__(self):
+        return self
+
+    def __getitem__(self, key):
+        return getattr(self, key) if (key in self.fieldSet) else None
+
+    def __setitem__(self, key, value):
+        if (key not in self.fieldSet):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default = None):
+        return getattr(self, key) if (key in self.fieldSet) else default
 
     def __eq__(self, other):
-        for key in self.__slots__:
+        for key in self.fields:
             if (self[key] != other[key]):
                 return False
         return True
 
     def __ne__(self, other):
-        for key in self.__slots__:
-            if (self[key] != other[key]):
-                return True
-        return False
+        return not self.__eq__(other)
 
     def __len__(self):
-        return len(self.__slots__)
+        return len(self.fields)
     
     def __iter__(self):
-        return iter(self.__slots__)
+        return iter(self.fields)
     
     def __contains__(self, key):
-        return (key in self.__slots__)
+        return (key in self.fieldSet)
 
     def copy(self):
-        clone = self.__class__()
+        clone = self.__class__.__new__(self.__class__)
         for key in self.__slots__:
-            clone[key] = self[key]
+            setattr(clone, key, getattr(self, key))
         return clone
+
+    # copy and pickle would take the __dict__ property for instance state
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
     
     def keys(self):
-        return self.__slots__
+        return list(self.fields)
 
     def has_key(self, key):
-        return (key in self)
+        return (key in self.fieldSet)
+
+    def values(self):
+        return [getattr(self, key) for key in self.fields]
 
     def items(self):
-        return [(key, self[key]) for key in self.__slots__]
+        return [(key, getattr(self, key)) for key in self.fields]
 
     def iteritems(self):
-        return iter(self.items())
+        for key in self.fields:
+            yield (key, getattr(self, key))
 
     def iterkeys(self):
-        return self.__iter__()
+        return iter(self.fields)
 
     def itervalues(self):
-        return iter(self.items())
+        for key in self.fields:
+            yield getattr(self, key)
 
     def __str__(self):
-        return '{ ' + ', '.join([key + ': ' + str(self[key]) for key in self.__slots__]) + ' }'
+        return '{ ' + ', '.join([key + ': ' + str(self[key]) for key in self.fields]) + ' }'
 
 
 class Metadata(NamedDict):
-    __slots__ = ('name', 'title', 'asserts', 'credits', 'reviewers', 'flags', 'links', 'references', 'revision', 'selftest', 'scripttest')
+    fields = ('name', 'title', 'asserts', 'credits', 'reviewers', 'flags', 'links', 'references', 'revision', 'selftest', 'scripttest')
+    fieldSet = frozenset(fields)
+    __slots__ = fields
 
     def __init__(self, name = None, title = None, asserts = [], credits = [], reviewers = [], flags = [], links = [],
                  references = [], revision = None, selftest = True, scripttest = False):
@@ -371,60 +1018,11 @@ class Metadata(NamedDict):
         self.selftest = selftest
         self.scripttest = scripttest
 
-    def __getitem__(self, key):
-        if ('name' == key):
-            return self.name
-        if ('title' == key):
-            return self.title
-        if ('asserts' == key):
-            return self.asserts
-        if ('credits' == key):
-            return self.credits
-        if ('reviewers' == key):
-            return self.reviewers
-        if ('flags' == key):
-            return self.flags
-        if ('links' == key):
-            return self.links
-        if ('references' == key):
-            return self.references
-        if ('revision' == key):
-            return self.revision
-        if ('selftest' == key):
-            return self.selftest
-        if ('scripttest' == key):
-            return self.scripttest
-        return None
-    
-    def __setitem__(self, key, value):
-        if ('name' == key):
-            self.name = value
-        elif ('title' == key):
-            self.title = value
-        elif ('asserts' == key):
-            self.asserts = value
-        elif ('credits' == key):
-            self.credits = value
-        elif ('reviewers' == key):
-            self.reviewers = value
-        elif ('flags' == key):
-            self.flags = value
-        elif ('links' == key):
-            self.links = value
-        elif ('references' == key):
-            self.references = value
-        elif ('revision' == key):
-            self.revision = value
-        elif ('selftest' == key):
-            self.selftest = value
-        elif ('scripttest' == key):
-            self.scripttest = value
-        else:
-            raise KeyError()
-
 
 class ReferenceData(NamedDict):
-    __slots__ = ('name', 'type', 'relpath', 'repopath')
+    fields = ('name', 'type', 'relpath', 'repopath')
+    fieldSet = frozenset(fields)
+    __slots__ = fields
     
     def __init__(self, name = None, type = None, relpath = None, repopath = None):
         self.name = name
@@ -432,29 +1030,6 @@ class ReferenceData(NamedDict):
         self.relpath = relpath
         self.repopath = repopath
 
-    def __getitem__(self, key):
-        if ('name' == key):
-            return self.name
-        if ('type' == key):
-            return self.type
-        if ('relpath' == key):
-            return self.relpath
-        if ('repopath' == key):
-            return self.repopath
-        return None
-
-    def __setitem__(self, key, value):
-        if ('name' == key):
-            self.name = value
-        elif ('type' == key):
-            self.type = value
-        elif ('relpath' == key):
-            self.relpath = value
-        elif ('repopath' == key):
-            self.repopath = value
-        else:
-            raise KeyError()
-
 UserData = collections.namedtuple('UserData', ('name', 'link'))
 
 class LineString(str):
@@ -473,6 +1048,8 @@ class FileSource:
      FileSources.
   """
 
+  serializations = None  # serializations kept for reuse, see shareSerializations()
+
   def __init__(self, sourceTree, sourcepath, relpath, mimetype = None, data = None):
     """Init FileSource from source path. Give it relative path relpath.
 
@@ -494,12 +1071,23 @@ class FileSource:
     self.scripts    = {}
     self.metadata   = None
     self.metaSource = None
+    self.parseCache = None
+    self.treeCache  = None
+    self.cached     = False   # parse results loaded without the parsed data
+    self.scanMetadata = False # validate by scanning metadata only
+    self.scriptsAdjusted = False
+    self.metadataSnapshots = {}  # asUnicode -> (refsGeneration, metadata, Metadata)
+    self.flagSnapshot = None     # (metadata, frozenset of flags)
+    self.refGraph   = None
+    self._digest    = None
 
   def __eq__(self, other):
     if not isinstance(other, FileSource):
       return False
-    return self.sourcepath == other.sourcepath or \
-           filecmp.cmp(self.sourcepath, other.sourcepath)
+    if self.sourcepath == other.sourcepath:
+      return True
+    with BuildProfile.phase('compare', self):
+      return self.contentDigest() == other.contentDigest()
 
   def __ne__(self, other):
     return not self == other
@@ -523,6 +1111,21 @@ class FileSource:
     if (self._data.startswith(codecs.BOM_UTF8)):
       self.encoding = 'utf-8-sig' # XXX look for other unicode BOMs
     return self._data
+
+  def sourceData(self):
+    """Return file contents as found in the source tree, as a byte string."""
+    return self.data()
+
+  def contentDigest(self):
+    """Returns the SHA-1 digest of the source file contents. It is computed
+       once, from the data if already loaded, else by mapping the file.
+    """
+    if (self._digest is None):
+      if (self._data is not None):
+        self._digest = hashlib.sha1(self._data).digest()
+      else:
+        self._digest = fileDigest(self.sourcepath)
+    return self._digest
     
   def unicode(self):
     try:
@@ -538,44 +1141,80 @@ class FileSource:
     """Ensure data is loaded from sourcepath."""
     self.parse()
 
+  def loadTree(self):
+    """Ensure everything needed to modify or serialize the source is loaded."""
+    self.validate()
+
   def adjustContentPaths(self, format):
     """Adjust any paths in file content for output format
        XXX need to account for group paths"""
     if (self.refs):
-      seenRefs = {}
-      seenRefs[self.sourcepath] = '=='
-      def adjustReferences(source):
-        newRefs = {}
-        for refName in source.refs:
-          refType, refPath, refNode, refSource = source.refs[refName]
-          if refSource:
-            refPath = relativeURL(format.dest(self.relpath), format.dest(refSource.relpath))
-            if (refSource.sourcepath not in seenRefs):
-              seenRefs[refSource.sourcepath] = refType
-              adjustReferences(refSource)
-          else:
-            refPath = relativeURL(format.dest(self.relpath), format.dest(refPath))
-          if (refPath != refNode.get('href')):
-            refNode.set('href', refPath)
-          newRefs[refName] = (refType, refPath, refNode, refSource) # update path in metadata
-        source.refs = newRefs
-      adjustReferences(self)
-
-    if (self.scripts):   # force testharness.js scripts to absolute path
-      for src in self.scripts:
-        if (src.endswith('/resources/testharness.js')):   # accept relative paths to testharness.js
-            scriptNode = self.scripts[src]
-            scriptNode.set('src', '/resources/testharness.js')
-        elif (src.endswith('/resources/testharnessreport.js')):
-            scriptNode = self.scripts[src]
-            scriptNode.set('src', '/resources/testharnessreport.js')
+      for source in [self] + self.referenceGraph().closure(self):
+        source.adjustReferencePaths(self, format)
+
+    if (self.scripts):
+      self.loadTree()
+      self.adjustScripts()
+
+  def adjustReferencePaths(self, test, format):
+    """Adjust the reference paths in file content for output format `format`,
+       relative to the output path of `test`, which is this source or
+       references it transitively."""
+    self.loadTree()
+    newRefs = {}
+    changed = False
+    for refName, (refType, oldPath, refNode, refSource) in self.refs.items():
+      if refSource:
+        refPath = relativeURL(format.dest(test.relpath), format.dest(refSource.relpath))
+      else:
+        refPath = relativeURL(format.dest(test.relpath), format.dest(oldPath))
+      if ((refNode is not None) and (refPath != refNode.get('href'))):
+        refNode.set('href', refPath)
+      changed = changed or (refPath != oldPath)
+      newRefs[refName] = (refType, refPath, refNode, refSource) # update path in metadata
+    if (changed):
+      self.refs = newRefs
+      self.refsChanged(False)
+
+  def adjustScripts(self):
+    """Force testharness.js scripts to absolute path."""
+    self.scriptsAdjusted = True
+    for src in self.scripts:
+      if (src.endswith('/resources/testharness.js')):   # accept relative paths to testharness.js
+          path = '/resources/testharness.js'
+      elif (src.endswith('/resources/testharnessreport.js')):
+          path = '/resources/testharnessreport.js'
+      else:
+          continue
+      scriptNode = self.scripts[src]
+      if (scriptNode.get('src') != path):
+          scriptNode.set('src', path)
+          self.contentChanged()
+
+  def shareSerializations(self, share = True):
+    """While `share` is True, serializations of this source are kept and
+       reused, so output formats that serialize it the same way with the
+       same reference paths share the work."""
+    self.serializations = {} if share else None
+
+  def serializationKey(self, name):
+    """Returns the key of the serialization by method `name` of the
+       content in its current state, see shareSerializations()."""
+    return (name, tuple(sorted((refName, ref[1]) for refName, ref in self.refs.items())))
+
+  def contentChanged(self):
+    """Drop the kept serializations after a change to the content other
+       than to reference paths."""
+    if (self.serializations):
+      self.serializations = {}
 
     
   def write(self, format):
     """Writes FileSource.data() out to `self.relpath` through Format `format`."""
     data = self.data()
-    f = open(format.dest(self.relpath), 'w')
-    f.write(data)
+    with BuildProfile.phase('write', self):
+      format.writeFile(format.dest(self.relpath), data)
+    BuildProfile.countFile(len(data))
     if (self.metaSource):
       self.metaSource.write(format) # XXX need to get output path from format, but not let it choose actual format
 
@@ -587,18 +1226,22 @@ class FileSource:
     """Returns hash of the contents of this file and any related file, references, support files, etc.
        XXX also needs to account for .meta file
     """
-    sha = hashlib.sha1()
-    sha.update(self.data())
-    seenRefs = set(self.sourcepath)
-    def hashReference(source):
-        for refName in source.refs:
-            refSource = source.refs[refName][3]
-            if (refSource and (refSource.sourcepath not in seenRefs)):
-                sha.update(refSource.data())
-                seenRefs.add(refSource.sourcepath)
-                hashReference(refSource)
-    hashReference(self)
-    return sha.hexdigest()
+    return self.referenceGraph().revision(self)
+
+  def refsChanged(self, edges = True):
+    """Invalidate memoized metadata after a change to the references
+       or parse results of this source. Metadata lists the references of
+       references, so this invalidates the metadata of all sources in its
+       ReferenceGraph. `edges` is False if only reference paths changed,
+       which keeps the memoized results of the ReferenceGraph.
+    """
+    self.referenceGraph().changed(edges)
+
+  def referenceGraph(self):
+    """Returns the ReferenceGraph of the SourceCache of this source."""
+    if (self.refGraph is None):
+      self.refGraph = ReferenceGraph()
+    return self.refGraph
 
   def loadMetadata(self):
     """Look for .meta file and load any metadata from it if present
@@ -627,9 +1270,15 @@ class FileSource:
          - selftest [bool]
          - scripttest [bool]
        Strings are given in ascii unless asUnicode==True.
+       The result is memoized until references or parse results change
+       and must not be modified.
     """
     
     self.validate()
+    snapshot = self.metadataSnapshots.get(asUnicode)
+    generation = self.referenceGraph().refsGeneration
+    if (snapshot and (snapshot[0] == generation) and (snapshot[1] is self.metadata)):
+      return snapshot[2]
 
     def encode(str):
         return str if (hasattr(str, 'line')) else intern(str.encode('utf-8'))
@@ -637,73 +1286,15 @@ class FileSource:
     def escape(str, andIntern = True):
       return str.encode('utf-8') if asUnicode else intern(escapeToNamedASCII(str)) if andIntern else escapeToNamedASCII(str)
 
-    def listReferences(source, seen):
-        refGroups = []
-        for refType, refRelPath, refNode, refSource in source.refs.values():
-            if ('==' == refType):
-                if (refSource):
-                    refSourcePath = refSource.sourcepath
-                else:
-                    refSourcePath = os.path.normpath(join(basepath(source.sourcepath), refRelPath))
-                if (refSourcePath in seen):
-                    continue
-                seen.add(refSourcePath)
-                if (refSource):
-                    sourceData = ReferenceData(name = self.sourceTree.getAssetName(refSourcePath), type = refType,
-                                               relpath = refRelPath, repopath = refSourcePath)
-                    if (refSource.refs):
-                        subRefLists = listReferences(refSource, seen.copy())
-                        if (subRefLists):
-                            for subRefList in subRefLists:
-                                refGroups.append([sourceData] + subRefList)
-                        else:
-                            refGroups.append([sourceData])
-                    else:
-                        refGroups.append([sourceData])
-                else:
-                    sourceData = ReferenceData(name = self.sourceTree.getAssetName(refSourcePath), type = refType,
-                                               relpath = relativeURL(self.sourcepath, refSourcePath),
-                                               repopath = refSourcePath)
-                    refGroups.append([sourceData])
-        notRefs = {}
-        for refType, refRelPath, refNode, refSource in source.refs.values():
-            if ('!=' == refType):
-                if (refSource):
-                    refSourcePath = refSource.sourcepath
-                else:
-                    refSourcePath = os.path.normpath(join(basepath(source.sourcepath), refRelPath))
-                if (refSourcePath in seen):
-                    continue
-                seen.add(refSourcePath)
-                if (refSource):
-                    sourceData = ReferenceData(name = self.sourceTree.getAssetName(refSourcePath), type = refType,
-                                               relpath = refRelPath, repopath = refSourcePath)
-                    notRefs[sourceData.name] = sourceData
-                    if (refSource.refs):
-                        for subRefList in listReferences(refSource, seen):
-                            for subRefData in subRefList:
-                                notRefs[subRefData.name] = subRefData
-                else:
-                    sourceData = ReferenceData(name = self.sourceTree.getAssetName(refSourcePath), type = refType,
-                                               relpath = relativeURL(self.sourcepath, refSourcePath),
-                                               repopath = refSourcePath)
-                    notRefs[sourceData.name] = sourceData
-        if (notRefs):
-            for refData in notRefs.values():
-                refData.type = '!='
-            if (refGroups):
-                for refGroup in refGroups:
-                    for notRef in notRefs.values():
-                        for ref in refGroup:
-                            if (ref.name == notRef.name):
-                                break
-                        else:
-                            refGroup.append(notRef)
-            else:
-                refGroups.append(notRefs.values())
-        return refGroups
-  
-    references = listReferences(self, set([self.sourcepath])) if (self.refs) else None
+    def referenceData(entry):
+        name, refSourcePath, parent, refName, refType = entry
+        refRelPath, refSource = parent.refs[refName][1::2]
+        return ReferenceData(name = name, type = refType,
+                             relpath = refRelPath if refSource else relativeURL(self.sourcepath, refSourcePath),
+                             repopath = refSourcePath)
+
+    references = [[referenceData(entry) for entry in chain]
+                  for chain in self.referenceGraph().chains(self)] if (self.refs) else None
 
     if (self.metadata):
       data = Metadata(
@@ -719,14 +1310,29 @@ class FileSource:
               selftest   = self.isSelftest(),
               scripttest = self.isScripttest()
              )
-      return data
-    return None
+    else:
+      data = None
+    self.metadataSnapshots[asUnicode] = (generation, self.metadata, data)
+    return data
 
   def addReference(self, referenceSource, match = None):
-    """Add reference source."""
-    self.validate()
+    """Add reference source. Without a loaded tree the reference is only
+       recorded; loadTree() applies it to the tree (see restoreReferences).
+    """
     refName = referenceSource.name()
     refPath = self.relativeURL(referenceSource)
+    if (self.cached):
+      if refName not in self.refs:
+        self.refs[refName] = (match, refPath, None, referenceSource)
+        self.refsChanged()
+      else:
+        oldMatch, oldPath, node, oldSource = self.refs[refName]
+        match = match or oldMatch
+        self.refs[refName] = (match, refPath, None, referenceSource)
+        self.refsChanged((match != oldMatch) or (referenceSource is not oldSource))
+      return
+    self.loadTree()
+    self.contentChanged()
     if refName not in self.refs:
       node = None
       if match == '==':
@@ -734,14 +1340,16 @@ class FileSource:
       elif match == '!=':
         node = self.augmentMetadata(notReference=referenceSource).notReference
       self.refs[refName] = (match, refPath, node, referenceSource)
+      self.refsChanged()
     else:
-      node = self.refs[refName][2]
+      oldMatch, oldPath, node, oldSource = self.refs[refName]
       node.set('href', refPath)
       if (match):
         node.set('rel', 'mismatch' if ('!=' == match) else 'match')
       else:
-        match = self.refs[refName][0]
+        match = oldMatch
       self.refs[refName] = (match, refPath, node, referenceSource)
+      self.refsChanged((match != oldMatch) or (referenceSource is not oldSource))
 
   def getReferencePaths(self):
     """Get list of paths to references as tuple(path, relPath, refType)."""
@@ -769,10 +1377,11 @@ class FileSource:
     return False
 
   def hasFlag(self, flag):
-    data = self.getMetadata()
-    if data:
-      return flag in data['flags']
-    return False
+    self.validate()
+    if ((self.flagSnapshot is None) or (self.flagSnapshot[0] is not self.metadata)):
+      flags = frozenset(self.metadata['flags']) if self.metadata else frozenset()
+      self.flagSnapshot = (self.metadata, flags)
+    return flag in self.flagSnapshot[1]
 
 
     
@@ -786,6 +1395,7 @@ class ConfigSource(FileSource):
     """
     FileSource.__init__(self, sourceTree, sourcepath, relpath, mimetype, data)
     self.sourcepath = [sourcepath]
+    self.digests = {} # path -> content digest
 
   def __eq__(self, other):
     if not isinstance(other, ConfigSource):
@@ -794,16 +1404,24 @@ class ConfigSource(FileSource):
       return True
     if len(self.sourcepath) != len(other.sourcepath):
       return False
-    for this, that in zip(self.sourcepath, other.sourcepath):
-      if not filecmp.cmp(this, that):
-        return False
-    return True
+    with BuildProfile.phase('compare', self):
+      return self.fileDigests() == other.fileDigests()
 
   def __ne__(self, other):
     return not self == other
 
   def name(self):
     return '.htaccess'
+
+  def fileDigests(self):
+    """Returns the list of content digests of all config files."""
+    for path in self.sourcepath:
+      if (path not in self.digests):
+        self.digests[path] = fileDigest(path)
+    return [self.digests[path] for path in self.sourcepath]
+
+  def contentDigest(self):
+    return hashlib.sha1(''.join(self.fileDigests())).digest()
     
   def type(self):
     return intern('support')
@@ -874,11 +1492,11 @@ class ReftestManifest(ConfigSource):
                     m.group(1))
 #          for strip in striplist:
             # strip relrecord
-          if not exists(record[0][0]):
+          if not self.sourceTree.exists(record[0][0]):
             raise ReftestFilepathError("Manifest Error in %s: "
                                        "Reftest test file %s does not exist." \
                                         % (src, record[0][0]))
-          elif not exists(record[0][1]):
+          elif not self.sourceTree.exists(record[0][1]):
             raise ReftestFilepathError("Manifest Error in %s: "
                                        "Reftest reference file %s does not exist." \
                                        % (src, record[0][1]))
@@ -898,6 +1516,16 @@ svgns = '{http://www.w3.org/2000/svg}'
 xmlns = '{http://www.w3.org/XML/1998/namespace}'
 xlinkns = '{http://www.w3.org/1999/xlink}'
 
+# Patterns for XMLSource.extractMetadata, compiled once
+relSeparatorRE = re.compile(r'\s+')
+titlePrefixRE = re.compile('(?:[^:]*)[tT]est(?:[^:]*):(.*)', re.DOTALL)
+matchRels = frozenset(('match', 'reference'))
+mismatchRels = frozenset(('mismatch', 'not-reference'))
+
+def relTokens(rel):
+  """Returns the set of link types in `rel` attribute value."""
+  return frozenset(relSeparatorRE.split(rel)) if (rel) else frozenset()
+
 class XMLSource(FileSource):
   """FileSource object with support reading XML trees."""
 
@@ -939,7 +1567,6 @@ class XMLSource(FileSource):
   def cacheAsParseError(self, filename, e):
       """Replace document with an error message."""
       errorDoc = self.syntaxErrorDoc % (filename, e)
-      from StringIO import StringIO 
       self.tree = etree.parse(StringIO(errorDoc), parser=self.__parser)
 
   def parse(self):
@@ -951,6 +1578,7 @@ class XMLSource(FileSource):
         self.tree = etree.parse(StringReader(data), parser=self.__parser)
         self.encoding = self.tree.docinfo.encoding or 'utf-8'
         self.injectedTags = {}
+        self.contentChanged()
       else:
         self.tree = None
         self.errors = ['Empty source file']
@@ -967,9 +1595,150 @@ class XMLSource(FileSource):
       self.encoding = 'utf-8'
       
   def validate(self):
-    """Parse file if not parsed, and store any parse errors in self.errors"""
-    if self.tree is None:
+    """Parse file if not parsed, and store any parse errors in self.errors.
+       Parse results are taken from the parse cache, if any, without
+       building the tree.
+    """
+    if (self.tree is None) and (not self.cached):
+      if (self.parseCache and self.parseCache.load(self)):
+        self.cached = True
+      elif (self.scanMetadata and self.timedScan()):
+        self.cached = True
+      else:
+        self.timedParse()
+        if (self.parseCache):
+          self.parseCache.store(self)
+        if (self.treeCache and (self.tree is not None)):
+          self.treeCache.touch(self)
+      if (self.errors):
+        BuildProfile.count('parse errors')
+
+  def timedParse(self, edges = True):
+    with BuildProfile.phase('parse', self):
       self.parse()
+    self.refsChanged(edges)
+
+  metadataContainerTag = xhtmlns+'head'
+  scanChunkSize = 1024  # bytes parsed at a time by scan()
+  __scanParsers = {}    # metadataContainerTag -> XMLPullParser
+
+  def scanParser(self):
+    """Returns the reusable pull parser reporting the end of elements of
+       tag metadataContainerTag."""
+    tag = self.metadataContainerTag
+    if tag not in XMLSource.__scanParsers:
+      XMLSource.__scanParsers[tag] = etree.XMLPullParser(events = ('end',), tag = tag,
+                                                         no_network = True,
+                                                         remove_comments = False,
+                                                         strip_cdata = False,
+                                                         resolve_entities = False)
+    return XMLSource.__scanParsers[tag]
+
+  def resetParser(self, parser):
+    """Abandon the document fed to pull parser `parser`."""
+    try:
+      parser.close()
+    except etree.ParseError:
+      pass
+    for event in parser.read_events():
+      pass
+
+  def isMetadataContainer(self, element):
+    """Returns True if `element`, of tag metadataContainerTag, is the
+       metadata container returned by getMeatdataContainer."""
+    parent = element.getparent()
+    return (parent is not None) and (parent.getparent() is None)
+
+  def scan(self):
+    """Extract metadata, references and scripts like parse(), but
+       without building the full tree: the file is parsed incrementally
+       only up to the end of the metadata container. Results are kept as
+       if loaded from the parse cache, the tree is parsed by loadTree().
+       Syntax errors after the metadata container are only reported by
+       that full parse. Returns False if the source cannot be scanned,
+       including on syntax errors before the end of the container.
+    """
+    self.errors = None
+    data = self.data()
+    if (not data):
+      self.errors = ['Empty source file']
+      self.encoding = 'utf-8'
+      return True
+    parser = self.scanParser()
+    container = None
+    try:
+      for start in xrange(0, len(data), self.scanChunkSize):
+        parser.feed(data[start:start + self.scanChunkSize])
+        for event, element in parser.read_events():
+          if self.isMetadataContainer(element):
+            container = element
+            break
+        if (container is not None):
+          tree = container.getroottree()
+          break
+      else:
+        tree = parser.close().getroottree()
+    except etree.ParseError:
+      self.resetParser(parser)
+      return False # let parse() report it
+    if (container is not None):
+      self.resetParser(parser)
+    # docinfo only has declared encodings before the end of the file
+    self.encoding = tree.docinfo.encoding or 'UTF-8'
+
+    FileSource.loadMetadata(self)
+    if (not self.metadata):
+      self.extractMetadata(None, list(container) if (container is not None) else [])
+    for refName, ref in self.refs.items():
+      self.refs[refName] = ref[:2] + (None, None)
+    for src in self.scripts:
+      self.scripts[src] = None
+    return True
+
+  def timedScan(self):
+    with BuildProfile.phase('scan', self):
+      scanned = self.scan()
+    if (scanned):
+      self.refsChanged()
+    return scanned
+
+  def loadTree(self):
+    """Parse file if the tree is not loaded. Parse results restored
+       from the parse cache or kept by compact() are replaced by those
+       of the fresh parse, preserving added and adjusted references.
+    """
+    if self.tree is None:
+      if (self.cached):
+        refs = self.refs
+        self.metadata = None
+        self.refs = {}
+        self.scripts = {}
+        self.cached = False
+        self.timedParse(False)
+        self.restoreReferences(refs)
+        if (self.scriptsAdjusted and self.scripts):
+          self.adjustScripts()
+      else:
+        self.timedParse()
+    if (self.treeCache and (self.tree is not None)):
+      self.treeCache.touch(self)
+
+  def restoreReferences(self, refs):
+    """Reapply reference map `refs` saved before the tree was reparsed."""
+    for refName, (refType, refPath, refNode, refSource) in refs.items():
+      if (refSource):
+        if (refName in self.refs):
+          match = self.refs[refName][0]
+          self.refs[refName] = self.refs[refName][:3] + (refSource,)
+          self.addReference(refSource, refType if (refType != match) else None)
+        else:
+          self.addReference(refSource, refType)
+      if (refName in self.refs):
+        match, path, node, source = self.refs[refName]
+        if ((node is not None) and (path != refPath)):
+          node.set('href', refPath)
+          self.refs[refName] = (match, refPath, node, source)
+          self.refsChanged(False)
 
   def getMeatdataContainer(self):
     return self.tree.getroot().find(xhtmlns+'head')
@@ -979,7 +1748,7 @@ class XMLSource(FileSource):
        Injected element is tagged with `tagCode`, which can be
        used to clear it with clearInjectedTags later.
     """
-    self.validate()
+    self.loadTree()
     container = self.getMeatdataContainer()
     if (container):
       node = etree.Element(xhtmlns+'link', {'rel': rel, 'href': href})
@@ -994,18 +1763,30 @@ class XMLSource(FileSource):
        elements tagged with `tagCode` if `tagCode` is given.
     """
     if not self.injectedTags or not self.tree: return
+    self.contentChanged()
     for node in self.injectedTags:
       node.getparent().remove(node)
       del self.injectedTags[node]
 
   def serializeXML(self):
-    self.validate()
-    return etree.tounicode(self.tree)
+    self.loadTree()
+    if (self.serializations is not None):
+      key = self.serializationKey('serializeXML')
+      output = self.serializations.get(key)
+      if (output is None):
+        with BuildProfile.phase('serialize', self):
+          output = self.serializations[key] = etree.tounicode(self.tree)
+      return output
+    with BuildProfile.phase('serialize', self):
+      return etree.tounicode(self.tree)
 
   def data(self):
     if ((not self.tree) or (self.metaSource)):
       return FileSource.data(self)
     return self.serializeXML().encode(self.encoding, 'xmlcharrefreplace')
+
+  def sourceData(self):
+    return FileSource.data(self)
     
   def unicode(self):
     if ((not self.tree) or (self.metaSource)):
@@ -1015,17 +1796,52 @@ class XMLSource(FileSource):
   def write(self, format, output=None):
     """Write Source through OutputFormat `format`.
        Write contents as string `output` instead if specified.
+       `output` may also be a serialization method, e.g. `self.serializeHTML`,
+       which is then called to stream its output directly into the file.
+       Serializations kept by shareSerializations() are reused.
     """
-    if not output:
+    key = None
+    data = None
+    if (self.serializations is not None) and not isinstance(output, basestring):
+      key = self.serializationKey(output.__name__ if output else 'unicode')
+      data = self.serializations.get(key)
+    if (data is None) and not output:
+      self.loadTree()
       output = self.unicode()
 
     # write
-    f = open(format.dest(self.relpath), 'w')
-    f.write(output.encode(self.encoding, 'xmlcharrefreplace'))
-    f.close()
+    with BuildProfile.phase('write', self):
+      dest = format.dest(self.relpath)
+      f = format.openFile(dest) if ((data is None) and (not key) and callable(output)) else None
+      if f:
+        with f:
+          output(outFile = f)
+          size = f.tell()
+      else:
+        if (data is None):
+          if callable(output):
+            buffer = StringIO()
+            output(outFile = buffer)
+            data = buffer.getvalue()
+          else:
+            data = output.encode(self.encoding, 'xmlcharrefreplace')
+          if (key):
+            self.serializations[key] = data
+        format.writeFile(dest, data)
+        size = len(data)
+    BuildProfile.countFile(size)
 
   def compact(self):
-    self.tree = None
+    """Drop the parsed tree, keeping metadata and references."""
+    if self.tree is not None:
+      self.tree = None
+      self.injectedTags = {}
+      self.contentChanged()
+      self.refs = dict((refName, (ref[0], ref[1], None, ref[3])) for refName, ref in self.refs.items())
+      self.scripts = dict((src, None) for src in self.scripts)
+      self.cached = True
+      if (self.treeCache):
+        self.treeCache.discard(self)
 
   def getMetadataElements(self, tree):
     container = self.getMeatdataContainer()
@@ -1033,24 +1849,40 @@ class XMLSource(FileSource):
       return [node for node in container]
     return None
 
-  def extractMetadata(self, tree):
-    """Extract metadata from tree."""
+  # Metadata container children read by extractMetadata, mapped to their kind
+  metadataTags = {xhtmlns+'link': 'link', xhtmlns+'meta': 'meta',
+                  xhtmlns+'title': 'title', xhtmlns+'script': 'script'}
+  missingContainerError = "Missing <head> element"
+  missingContentErrors = {'flags': "Flags meta missing content attribute.",
+                          'assert': "Assert meta missing content attribute."}
+
+  def metadataProperty(self, node):
+    """Returns (metadata type, content string or None) of metadata
+       property element `node`, e.g. ('flags', 'ahem image')."""
+    metatype = node.get('name')
+    return (metatype.strip() if metatype else metatype, node.get('content'))
+
+  def extractMetadata(self, tree, metaElements = None):
+    """Extract metadata from tree, or from the children `metaElements`
+       of the metadata container if given."""
     links = []; credits = []; reviewers = []; flags = []; asserts = []; title = ''
 
-    def tokenMatch(token, string):
-        return bool(re.search('(^|\s+)%s($|\s+)' % token, string)) if (string) else False
-
     errors = []
     readFlags = False
-    metaElements = self.getMetadataElements(tree)
+    if (metaElements is None):
+      metaElements = self.getMetadataElements(tree)
     if (not metaElements):
-        errors.append("Missing <head> element")
+        errors.append(self.missingContainerError)
     else:
         # Scan and cache metadata
         for node in metaElements:
-            if (node.tag == xhtmlns+'link'):
+            kind = self.metadataTags.get(node.tag)
+            if (not kind):
+                continue
+            if ('link' == kind):
+                rel = relTokens(node.get('rel'))
                 # help links
-                if tokenMatch('help', node.get('rel')):
+                if ('help' in rel):
                     link = node.get('href').strip() if node.get('href') else None
                     if (not link):
                         errors.append(LineString("Help link missing href value.", node.sourceline))
@@ -1060,19 +1892,8 @@ class XMLSource(FileSource):
                         errors.append(LineString("Duplicate help link " + link.encode('utf-8') + ".", node.sourceline))
                     else:
                         links.append(LineString(link, node.sourceline))
-                # == references
-                elif tokenMatch('match', node.get('rel')) or tokenMatch('reference', node.get('rel')):
-                    refPath = node.get('href').strip() if node.get('href') else None
-                    if (not refPath):
-                        errors.append(LineString("Reference link missing href value.", node.sourceline))
-                    else:
-                        refName = self.sourceTree.getAssetName(join(self.sourcepath, refPath))
-                        if (refName in self.refs):
-                            errors.append(LineString("Reference " + refName.encode('utf-8') + " already specified.", node.sourceline))
-                        else:
-                            self.refs[refName] = ('==', refPath, node, None)
-                # != references
-                elif tokenMatch('mismatch', node.get('rel')) or tokenMatch('not-reference', node.get('rel')):
+                # == and != references
+                elif (not rel.isdisjoint(matchRels)) or (not rel.isdisjoint(mismatchRels)):
                     refPath = node.get('href').strip() if node.get('href') else None
                     if (not refPath):
                         errors.append(LineString("Reference link missing href value.", node.sourceline))
@@ -1081,10 +1902,11 @@ class XMLSource(FileSource):
                         if (refName in self.refs):
                             errors.append(LineString("Reference " + refName.encode('utf-8') + " already specified.", node.sourceline))
                         else:
-                            self.refs[refName] = ('!=', refPath, node, None)
+                            refType = '!=' if rel.isdisjoint(matchRels) else '=='
+                            self.refs[refName] = (refType, refPath, node, None)
                 else: # may have both author and reviewer in the same link
                     # credits
-                    if tokenMatch('author', node.get('rel')):
+                    if ('author' in rel):
                         name = node.get('title')
                         name = name.strip() if name else name
                         if (not name):
@@ -1096,7 +1918,7 @@ class XMLSource(FileSource):
                             else:
                                 credits.append((name, link))
                     # reviewers
-                    if tokenMatch('reviewer', node.get('rel')):
+                    if ('reviewer' in rel):
                         name = node.get('title')
                         name = name.strip() if name else name
                         if (not name):
@@ -1107,38 +1929,39 @@ class XMLSource(FileSource):
                                 errors.append(LineString("Reviewer link for \"" + name.encode('utf-8') + "\" missing contact URL (http or mailto).", node.sourceline))
                             else:
                                 reviewers.append((name, link))
-            elif (node.tag == xhtmlns+'meta'):
-                metatype = node.get('name')
-                metatype = metatype.strip() if metatype else metatype
+            # title
+            elif ('title' == kind):
+                title = node.text.strip() if node.text else ''
+                match = titlePrefixRE.match(title)
+                if (match):
+                    title = match.group(1)
+                title = title.strip()
+            # script
+            elif ('script' == kind):
+                src = node.get('src').strip() if node.get('src') else None
+                if (src):
+                    self.scripts[src] = node
+            else:
+                metatype, content = self.metadataProperty(node)
                 # requirement flags
                 if ('flags' == metatype):
                     if (readFlags):
                         errors.append(LineString("Flags must only be specified once.", node.sourceline))
                     else:
                         readFlags = True
-                        if (None == node.get('content')):
-                            errors.append(LineString("Flags meta missing content attribute.", node.sourceline))
+                        if (None == content):
+                            if ('flags' in self.missingContentErrors):
+                                errors.append(LineString(self.missingContentErrors['flags'], node.sourceline))
                         else:
-                            for flag in sorted(node.get('content').split()):
+                            for flag in sorted(content.split()):
                                 flags.append(flag)
                 # test assertions
                 elif ('assert' == metatype):
-                    if (None == node.get('content')):
-                        errors.append(LineString("Assert meta missing content attribute.", node.sourceline))
+                    if (None == content):
+                        if ('assert' in self.missingContentErrors):
+                            errors.append(LineString(self.missingContentErrors['assert'], node.sourceline))
                     else:
-                        asserts.append(node.get('content').strip().replace('\t', ' '))
-            # title
-            elif (node.tag == xhtmlns+'title'):
-                title = node.text.strip() if node.text else ''
-                match = re.match('(?:[^:]*)[tT]est(?:[^:]*):(.*)', title, re.DOTALL)
-                if (match):
-                    title = match.group(1)
-                title = title.strip()
-            # script
-            elif (node.tag == xhtmlns+'script'):
-                src = node.get('src').strip() if node.get('src') else None
-                if (src):
-                    self.scripts[src] = node
+                        asserts.append(content.strip().replace('\t', ' '))
 
     if (asserts or credits or reviewers or flags or links or title):
         self.metadata = {'asserts'   : asserts,
@@ -1161,7 +1984,7 @@ class XMLSource(FileSource):
           * Adds next/prev links to  next/prev Sources given
           * Adds reference link to reference Source given
      """
-     self.validate()
+     self.loadTree()
      if next:
        next = self.injectMetadataLink('next', self.relativeURL(next), 'next')
      if prev:
@@ -1188,12 +2011,19 @@ class XHTMLSource(XMLSource):
   def serializeXHTML(self, doctype = None):
     return self.serializeXML()
 
-  def serializeHTML(self, doctype = None):
-    self.validate()
+  def serializeHTML(self, doctype = None, outFile = None):
+    """Serialize as HTML. If `outFile` is given, the encoded output is
+       written to it instead of being returned.
+    """
+    self.loadTree()
     # Serialize
 #    print self.relpath
     serializer = HTMLSerializer.HTMLSerializer()
-    output = serializer.serializeHTML(self.tree, doctype)
+    with BuildProfile.phase('serialize', self):
+      if (outFile):
+        serializer.writeHTML(self.tree, outFile, doctype, self.encoding)
+        return None
+      output = serializer.serializeHTML(self.tree, doctype)
     return output
 
 
@@ -1214,134 +2044,128 @@ class SVGSource(XMLSource):
         return group
     return None
 
-  def extractMetadata(self, tree):
-    """Extract metadata from tree."""
-    links = []; credits = []; reviewers = []; flags = []; asserts = []; title = ''
+  metadataContainerTag = svgns+'g'
 
-    def tokenMatch(token, string):
-        return bool(re.search('(^|\s+)%s($|\s+)' % token, string)) if (string) else False
+  def isMetadataContainer(self, element):
+    return XMLSource.isMetadataContainer(self, element) and ('testmeta' == element.get('id'))
+
+  metadataTags = {xhtmlns+'link': 'link', svgns+'metadata': 'flags', svgns+'desc': 'assert',
+                  svgns+'title': 'title', svgns+'script': 'script'}
+  missingContainerError = "Missing <g id='testmeta'> element"
+  missingContentErrors = {'assert': "Assert desc missing text."}
+
+  def metadataProperty(self, node):
+    """Flags are given by <metadata class="flags">, assertions by
+       <desc class="assert">."""
+    metatype = node.get('class')
+    metatype = metatype.strip() if metatype else metatype
+    if (metatype != self.metadataTags[node.tag]):
+      return (None, None)
+    if ('flags' == metatype):
+      text = node.find(svgns+'text')
+      return (metatype, text.text if (text) else node.text)
+    return (metatype, node.text)
 
-    errors = []
-    readFlags = False
-    metaElements = self.getMetadataElements(tree)
-    if (not metaElements):
-        errors.append("Missing <g id='testmeta'> element")
-    else:
-        # Scan and cache metadata
-        for node in metaElements:
-            if (node.tag == xhtmlns+'link'):
-                # help links
-                if tokenMatch('help', node.get('rel')):
-                    link = node.get('href').strip() if node.get('href') else None
-                    if (not link):
-                        errors.append(LineString("Help link missing href value.", node.sourceline))
-                    elif (not (link.startswith('http://') or link.startswith('https://'))):
-                        errors.append(LineString("Help link " + link.encode('utf-8') + " must be absolute URL.", node.sourceline))
-                    elif (link in links):
-                        errors.append(LineString("Duplicate help link " + link.encode('utf-8') + ".", node.sourceline))
-                    else:
-                        links.append(LineString(link, node.sourceline))
-                # == references
-                elif tokenMatch('match', node.get('rel')) or tokenMatch('reference', node.get('rel')):
-                    refPath = node.get('href').strip() if node.get('href') else None
-                    if (not refPath):
-                        errors.append(LineString("Reference link missing href value.", node.sourceline))
-                    else:
-                        refName = self.sourceTree.getAssetName(join(self.sourcepath, refPath))
-                        if (refName in self.refs):
-                            errors.append(LineString("Reference " + refName.encode('utf-8') + " already specified.", node.sourceline))
-                        else:
-                            self.refs[refName] = ('==', refPath, node, None)
-                # != references
-                elif tokenMatch('mismatch', node.get('rel')) or tokenMatch('not-reference', node.get('rel')):
-                    refPath = node.get('href').strip() if node.get('href') else None
-                    if (not refPath):
-                        errors.append(LineString("Reference link missing href value.", node.sourceline))
-                    else:
-                        refName = self.sourceTree.getAssetName(join(self.sourcepath, refPath))
-                        if (refName in self.refs):
-                            errors.append(LineString("Reference " + refName.encode('utf-8') + " already specified.", node.sourceline))
-                        else:
-                            self.refs[refName] = ('!=', refPath, node, None)
-                else: # may have both author and reviewer in the same link
-                    # credits
-                    if tokenMatch('author', node.get('rel')):
-                        name = node.get('title')
-                        name = name.strip() if name else name
-                        if (not name):
-                            errors.append(LineString("Author link missing name (title attribute).", node.sourceline))
-                        else:
-                            link = node.get('href').strip() if node.get('href') else None
-                            if (not link):
-                                errors.append(LineString("Author link for \"" + name.encode('utf-8') + "\" missing contact URL (http or mailto).", node.sourceline))
-                            else:
-                                credits.append((name, link))
-                    # reviewers
-                    if tokenMatch('reviewer', node.get('rel')):
-                        name = node.get('title')
-                        name = name.strip() if name else name
-                        if (not name):
-                            errors.append(LineString("Reviewer link missing name (title attribute).", node.sourceline))
-                        else:
-                            link = node.get('href').strip() if node.get('href') else None
-                            if (not link):
-                                errors.append(LineString("Reviewer link for \"" + name.encode('utf-8') + "\" missing contact URL (http or mailto).", node.sourceline))
-                            else:
-                                reviewers.append((name, link))
-            elif (node.tag == svgns+'metadata'):
-                metatype = node.get('class')
-                metatype = metatype.strip() if metatype else metatype
-                # requirement flags
-                if ('flags' == metatype):
-                    if (readFlags):
-                        errors.append(LineString("Flags must only be specified once.", node.sourceline))
-                    else:
-                        readFlags = True
-                        text = node.find(svgns+'text')
-                        flagString = text.text if (text) else node.text
-                        if (flagString):
-                            for flag in sorted(flagString.split()):
-                                flags.append(flag)
-            elif (node.tag == svgns+'desc'):
-                metatype = node.get('class')
-                metatype = metatype.strip() if metatype else metatype
-                # test assertions
-                if ('assert' == metatype):
-                    asserts.append(node.text.strip().replace('\t', ' '))
-            # test title
-            elif node.tag == svgns+'title':
-                title = node.text.strip() if node.text else ''
-                match = re.match('(?:[^:]*)[tT]est(?:[^:]*):(.*)', title, re.DOTALL)
-                if (match):
-                    title = match.group(1)
-                title = title.strip()
-            # script tag (XXX restricted to metadata container?)
-            elif (node.tag == svgns+'script'):
-                src = node.get('src').strip() if node.get('src') else None
-                if (src):
-                    self.scripts[src] = node
 
-    if (asserts or credits or reviewers or flags or links or title):
-        self.metadata = {'asserts'   : asserts,
-                         'credits'   : credits,
-                         'reviewers' : reviewers,
-                         'flags'     : flags,
-                         'links'     : links,
-                         'title'     : title
-                        }
-    if (errors):
-        if (self.errors):
-            self.errors += errors
-        else:
-            self.errors = errors
 
+class HTML5LibParser:
+  """HTML parser backend using the pure Python html5lib."""
+  name = 'html5lib'
 
+  def __init__(self):
+    self.parser = html5lib.HTMLParser(tree = treebuilders.getTreeBuilder('lxml'))
+
+  def parse(self, data, encoding = None):
+    """Parse byte string `data` as `encoding`, or as the encoding it
+       declares if None. Returns (lxml ElementTree, encoding).
+    """
+    tree = self.parser.parse(data, encoding = encoding)
+    return (tree, encoding or self.parser.documentEncoding)
+
+class FastHTMLParser:
+  """HTML parser backend using the C html5-parser package. Produces the
+     same elements as html5lib's lxml tree builder, see reorderAttributes.
+  """
+  name = 'html5-parser'
+  defaultEncoding = 'windows-1252' # as html5lib without chardet
+  bomEncodings = {codecs.BOM_UTF8: 'utf-8',
+                  codecs.BOM_UTF16_LE: 'utf-16-le',
+                  codecs.BOM_UTF16_BE: 'utf-16-be'}
+  nonASCII = re.compile(r'[\x80-\xff]')
+
+  def _parse(self, data, encoding):
+    return html5_parser.parse(data, transport_encoding = encoding,
+                              namespace_elements = True, return_root = False)
+
+  def declaredEncoding(self, tree):
+    """Returns the codec named by the first <meta> charset declaration
+       in `tree`, or None.
+    """
+    for meta in tree.iter(xhtmlns + 'meta'):
+      charset = meta.get('charset')
+      if ((charset is None) and meta.get('content') and
+          ('content-type' == (meta.get('http-equiv') or '').strip().lower())):
+        charset = ContentAttrParser(EncodingBytes(meta.get('content').encode('ascii', 'ignore'))).parse()
+      if (charset is not None):
+        encoding = codec_name(charset)
+        if encoding:
+          return 'utf-8' if encoding.startswith('utf-16') else encoding
+
+  def parse(self, data, encoding = None):
+    """Parse byte string `data` as `encoding`, or as the encoding it
+       declares if None. Returns (lxml ElementTree, encoding).
+       Undeclared encodings are read from the parsed tree instead of a
+       separate prescan; the data is only parsed again if it declares a
+       legacy encoding and is not plain ASCII.
+    """
+    if encoding:
+      tree = self._parse(data, encoding)
+    else:
+      bom = html5_parser.check_bom(data)
+      if bom:
+        encoding = self.bomEncodings[bom]
+        tree = self._parse(data[len(bom):], encoding)
+      else:
+        tree = self._parse(data, 'utf-8')
+        encoding = self.declaredEncoding(tree) or self.defaultEncoding
+        if (('utf-8' != encoding) and self.nonASCII.search(data)):
+          tree = self._parse(data, encoding)
+    self.reorderAttributes(tree)
+    return (tree, encoding)
+
+  def reorderAttributes(self, tree):
+    """Put attributes of HTML elements in the order html5lib gives them,
+       the iteration order of a dict filled in reverse source order, so that
+       serialized output does not depend on the backend. Inline SVG and
+       MathML keep source order, and their xmlns attributes are namespace
+       declarations rather than attributes as with html5lib.
+    """
+    for element in tree.iter(xhtmlns + '*'):
+      attrib = element.attrib
+      if (1 < len(attrib)):
+        items = dict(reversed(attrib.items())).items()
+        attrib.clear()
+        for name, value in items:
+          attrib[name] = value
+
+htmlParsers = {HTML5LibParser.name: HTML5LibParser,
+               FastHTMLParser.name: FastHTMLParser}
+
+def setHTMLParser(name = None):
+  """Make HTMLSource parse with backend `name` from `htmlParsers`, or with
+     the fastest one available if None. Returns the backend.
+  """
+  if not name:
+    name = FastHTMLParser.name if html5_parser else HTML5LibParser.name
+  elif (FastHTMLParser.name == name) and (not html5_parser):
+    raise ValueError("HTML parser backend %s is not installed" % name)
+  HTMLSource.htmlParser = htmlParsers[name]()
+  return HTMLSource.htmlParser
 
 class HTMLSource(XMLSource):
   """FileSource object with support for HTML metadata and HTML->XHTML conversions (untested)."""
 
-  # Private Data and Methods
-  __parser = html5lib.HTMLParser(tree = treebuilders.getTreeBuilder('lxml'))
+  htmlParser = None # parser backend, see setHTMLParser
  
   # Public Methods
 
@@ -1350,6 +2174,10 @@ class HTMLSource(XMLSource):
     """
     XMLSource.__init__(self, sourceTree, sourcepath, relpath, data = data)
 
+  def scan(self):
+    """HTML is not parsed incrementally, see XMLSource.scan."""
+    return False
+
   def parse(self):
     """Parse file and store any parse errors in self.errors"""
     self.errors = None
@@ -1358,10 +2186,9 @@ class HTMLSource(XMLSource):
       if data:
         with warnings.catch_warnings():
           warnings.simplefilter("ignore")
-          htmlStream = html5lib.inputstream.HTMLInputStream(data)
-          if ('utf-8-sig' != self.encoding):  # if we found a BOM, respect it
-            self.encoding = htmlStream.detectEncoding()[0]
-          self.tree = self.__parser.parse(data, encoding = self.encoding)
+          # if we found a BOM, respect it
+          encoding = self.encoding if ('utf-8-sig' == self.encoding) else None
+          self.tree, self.encoding = self.htmlParser.parse(data, encoding)
           self.injectedTags = {}
       else:
         self.tree = None
@@ -1435,23 +2262,37 @@ class HTMLSource(XMLSource):
               else:
                   del element.attrib[attr]
     
-  def serializeXHTML(self, doctype = None):
-    self.validate()
+  def serializeXHTML(self, doctype = None, outFile = None):
+    """Serialize as XHTML. If `outFile` is given, the encoded output is
+       written to it instead of being returned.
+    """
+    self.loadTree()
     # Serialize
     nodeList = self.injectNamespaces()
 #    print self.relpath
     serializer = HTMLSerializer.HTMLSerializer()
-    o = serializer.serializeXHTML(self.tree, doctype)
+    with BuildProfile.phase('serialize', self):
+      if (outFile):
+        o = serializer.writeXHTML(self.tree, outFile, doctype, self.encoding)
+      else:
+        o = serializer.serializeXHTML(self.tree, doctype)
 
     self.removeNamespaces(nodeList)
     return o
 
-  def serializeHTML(self, doctype = None):
-    self.validate()
+  def serializeHTML(self, doctype = None, outFile = None):
+    """Serialize as HTML. If `outFile` is given, the encoded output is
+       written to it instead of being returned.
+    """
+    self.loadTree()
     # Serialize
 #    print self.relpath
     serializer = HTMLSerializer.HTMLSerializer()
-    o = serializer.serializeHTML(self.tree, doctype)
+    with BuildProfile.phase('serialize', self):
+      if (outFile):
+        o = serializer.writeHTML(self.tree, outFile, doctype, self.encoding)
+      else:
+        o = serializer.serializeHTML(self.tree, doctype)
 
     return o
 
@@ -1465,3 +2306,5 @@ class HTMLSource(XMLSource):
       return FileSource.unicode(self)
     return self.serializeHTML()
     
+
+setHTMLParser()
@@ -5,28 +5,110 @@
 
 import OutputFormats
 import Utils
+import BuildProfile
 from Groups import TestGroup, excludeDirs
 from Sources import SourceTree, SourceCache
-from shutil import copytree, rmtree
+from shutil import copytree, ignore_patterns
 from os.path import join
 import os
-from mercurial import ui as UserInterface, hg
+import sys
+import traceback
+import multiprocessing
+from Repositories import openRepository
+
+# Suite state shared with forked build workers; see TestSuite.buildInto
+_buildState = None
+
+class ConsoleUI:
+  """Default ui object, reporting like Mercurial's: messages go to
+     stdout, warnings to stderr, and notes only if `verbose` is set.
+  """
+  def __init__(self, verbose = False):
+    self.verbose = verbose
+
+  def write(self, *msg):
+    sys.stdout.write(''.join(msg))
+
+  status = write
+
+  def note(self, *msg):
+    if self.verbose:
+      self.write(*msg)
+
+  def warn(self, *msg):
+    sys.stdout.flush()
+    sys.stderr.write(''.join(msg))
+
+class WorkerUI:
+  """Stand-in for the ui object inside build worker processes.
+     Records messages so they can be replayed through the parent's ui.
+  """
+  def __init__(self):
+    self.messages = []
+
+  def _record(self, kind, *msg):
+    self.messages.append((kind, msg))
+
+  def write(self, *msg):
+    self._record('write', *msg)
+
+  def status(self, *msg):
+    self._record('status', *msg)
+
+  def note(self, *msg):
+    self._record('note', *msg)
+
+  def warn(self, *msg):
+    self._record('warn', *msg)
+
+def _buildWorker(task):
+  """Build one (format indices, group name) pair in a worker process.
+     Returns (task, recorded ui messages, formatted traceback or None,
+     build manifest entries or None, build profile data or None).
+  """
+  suite, formats = _buildState
+  formatIndices, groupName = task
+  formats = [formats[index] for index in formatIndices]
+  format = formats[0]
+  group = suite.groups[groupName]
+  group.ui = WorkerUI()
+  if format.manifest:
+    format.manifest.current = {}
+  profiler = None
+  if BuildProfile.current:
+    profiler = BuildProfile.start()
+    profiler.setContext(format, group)
+  try:
+    if (1 < len(formats)):
+      group.buildFormats(formats)
+    else:
+      group.build(format)
+    error = None
+  except Exception:
+    error = traceback.format_exc()
+  outputs = format.manifest.current if format.manifest else None
+  return (task, group.ui.messages, error, outputs, profiler.data() if profiler else None)
 
 class TestSuite:
   """Representation of a standard CSS test suite."""
 
-  def __init__(self, name, title, specUri, draftUri, sourceCache = None, ui = None):
+  def __init__(self, name, title, specUri, draftUri, sourceCache = None, ui = None, fileIndex = None):
+    """Without a SourceCache `sourceCache`, sources are loaded from the
+       repository in the current directory, and file system queries are
+       answered by Sources.FileIndex `fileIndex` if given.
+    """
     self.name = name
     self.title = title
     self.specroot = specUri
     self.draftroot = draftUri
 
-    self.ui = ui if ui else UserInterface.ui()
+    self.ui = ui if ui else ConsoleUI()
     self.defaultReftestRelpath='reftest.list'
     self.groups = {}
-    self.sourcecache = sourceCache if sourceCache else SourceCache(SourceTree(hg.repository(self.ui, '.')))
+    self.sourcecache = sourceCache if sourceCache else SourceCache(SourceTree(openRepository('.'), fileIndex))
     self.formats = ('html4', 'xhtml1', 'xhtml1print') # XXX FIXME, hardcoded list is lame
     self.rawgroups = {}
+    self.buildProfile = None
 
   def addTestsByExt(self, dir, ext, groupName='', groupTitle=''):
     """Add tests from directory `dir` by file extension (via `ext`, e.g. ext='.xht').
@@ -71,51 +153,177 @@ class TestSuite:
   def setFormats(self, formats):
     self.formats = formats
     
-  def buildInto(self, dest, indexer):
+  def buildInto(self, dest, indexer, jobs=1, incremental=False, profile=False, dedup=False,
+                writeIfChanged=False, writers=0, sourceMajor=False):
     """Builds test suite through all OutputFormats into directory at path `dest`
        or through OutputFormat destination `dest`, using Indexer `indexer`.
+       If `jobs` is greater than 1, formats and the groups within each format
+       are built in a pool of `jobs` worker processes.
+       If `incremental` is True, a build manifest is kept in `dest` and
+       outputs whose inputs did not change since the last build are not
+       rewritten; outputs no longer produced are deleted. A failed build
+       leaves the manifest of the previous build in place.
+       If `profile` is True, build phases are timed and a report table is
+       written through self.ui at the end; the BuildProfiler is kept in
+       self.buildProfile for its JSON summary. Profiling covers parsing done
+       before the build too if BuildProfile.start() was called beforehand.
+       If `dedup` is True, support and raw files are placed as hard links
+       into a content-addressed OutputFormats.BlobStore in `dest`, so each
+       distinct file is stored once.
+       If `writeIfChanged` is True, outputs whose contents did not change
+       are not rewritten, so their mtimes are preserved.
+       If `writers` is greater than 0, output files are written behind the
+       build by that many OutputFormats.OutputWriter threads.
+       If `sourceMajor` is True, each group is built through all formats at
+       once with TestGroup.buildFormats(), which serializes each source once
+       for all formats that output it the same way.
     """
-    if isinstance(dest, OutputFormats.BasicFormat):
-      formats = (dest,)
-      dest = dest.root
+    profiler = None
+    if profile:
+      profiler = BuildProfile.current or BuildProfile.start()
+    try:
+      if isinstance(dest, OutputFormats.BasicFormat):
+        formats = (dest,)
+        dest = dest.root
+      else:
+        formats = []
+        for format in self.formats:
+          if (format == 'html4'):
+            formats.append(OutputFormats.HTMLFormat(dest, self.sourcecache.sourceTree))
+          elif (format == 'html5'):
+            formats.append(OutputFormats.HTML5Format(dest, self.sourcecache.sourceTree))
+          elif (format == 'xhtml1'):
+            formats.append(OutputFormats.XHTMLFormat(dest, self.sourcecache.sourceTree))
+          elif (format == 'xhtml1print'):
+            formats.append(OutputFormats.XHTMLPrintFormat(dest, self.sourcecache.sourceTree, self.title))
+          elif (format == 'svg'):
+            formats.append(OutputFormats.SVGFormat(dest, self.sourcecache.sourceTree))
+
+      manifest = OutputFormats.BuildManifest(dest) if incremental else None
+      blobStore = OutputFormats.BlobStore(dest) if dedup else None
+      writer = OutputFormats.OutputWriter(writers) if (0 < writers) else None
+      for format in formats:
+        format.manifest = manifest
+        format.blobStore = blobStore
+        format.writeIfChanged = writeIfChanged
+        format.writer = writer
+      indexer.manifest = manifest
+      indexer.writer = writer
+
+      succeeded = False
+      try:
+        if (1 < jobs) and hasattr(os, 'fork'):
+          self._buildParallel(formats, jobs, sourceMajor)
+        elif sourceMajor:
+          for group in self.groups.itervalues():
+            group.buildFormats(formats)
+        else:
+          for format in formats:
+            for group in self.groups.itervalues():
+              BuildProfile.setContext(format, group)
+              group.build(format)
+
+        for group in self.groups.itervalues():
+          BuildProfile.setContext(None, group)
+          with BuildProfile.phase('index'):
+            indexer.indexGroup(group)
+
+        for format in formats:
+          BuildProfile.setContext(format)
+          indexer.writeIndex(format)
+
+
+        BuildProfile.setContext()
+        rawtests = []
+        copy = OutputFormats.copier(blobStore, writeIfChanged, writer)
+        sourceTree = self.sourcecache.sourceTree
+        for src, relpath in self.rawgroups.items():
+          with BuildProfile.phase('copy'):
+            if manifest:
+              manifest.copyTree(src, join(dest,relpath), excludeDirs, copy)
+            elif blobStore or writeIfChanged or writer:
+              Utils.copyTree(src, join(dest,relpath), excludeDirs, copy)
+            else:
+              copytree(src, join(dest,relpath), ignore = ignore_patterns(*excludeDirs))
+          for (root, dirs, files) in sourceTree.walk(src, excludeDirs):
+            rawDir = os.path.normpath(join(relpath, Utils.relpath(root, src)))
+            rawtests.extend(
+              [join(rawDir,file)
+               for file in files]
+            )
+
+        rawtests.sort()
+        indexer.writeOverview(dest, addTests=rawtests)
+        succeeded = True
+      finally:
+        if writer:
+          for format in formats:
+            format.writer = None
+          indexer.writer = None
+          try:
+            writer.close()   # raises errors of queued writes
+          except Exception:
+            if succeeded:
+              raise          # otherwise report the build's own error
+        indexer.close()
+
+      # After a failed build the manifest of the previous build is kept, so
+      # the next incremental build compares against the last complete build
+      # rather than a partial one; unused blobs are left for the next
+      # successful build to delete.
+      if manifest:
+        manifest.close()
+      if blobStore:
+        blobStore.close()
+    finally:
+      if profiler:
+        BuildProfile.stop()   # also after a failed build
+    if profiler:
+      self.buildProfile = profiler
+      self.ui.write(profiler.table())
+
+  def _buildParallel(self, formats, jobs, sourceMajor=False):
+    """Build every (format, group) pair of `formats` in a pool of `jobs`
+       forked worker processes, or every group through all formats at once
+       if `sourceMajor` is True. Worker messages and errors are reported
+       through self.ui; raises RuntimeError if any build task failed.
+    """
+    global _buildState
+    _buildState = (self, formats)
+    if sourceMajor:
+      tasks = [(tuple(range(len(formats))), name) for name in self.groups]
     else:
-      formats = []
-      for format in self.formats:
-        if (format == 'html4'):
-          formats.append(OutputFormats.HTMLFormat(dest, self.sourcecache.sourceTree))
-        elif (format == 'html5'):
-          formats.append(OutputFormats.HTML5Format(dest, self.sourcecache.sourceTree))
-        elif (format == 'xhtml1'):
-          formats.append(OutputFormats.XHTMLFormat(dest, self.sourcecache.sourceTree))
-        elif (format == 'xhtml1print'):
-          formats.append(OutputFormats.XHTMLPrintFormat(dest, self.sourcecache.sourceTree, self.title))
-        elif (format == 'svg'):
-          formats.append(OutputFormats.SVGFormat(dest, self.sourcecache.sourceTree))
-
-    for format in formats:
+      tasks = [((index,), name) for index in range(len(formats)) for name in self.groups]
+    failures = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+      for (indices, name), messages, error, outputs, profile in pool.imap_unordered(_buildWorker, tasks):
+        for kind, msg in messages:
+          getattr(self.ui, kind)(*msg)
+        if outputs:
+          formats[indices[0]].manifest.update(outputs)
+        if profile:
+          BuildProfile.current.merge(profile)
+        if error:
+          failures += 1
+          self.ui.warn("Error building group %s in format %s:\n" % \
+                       (name, ', '.join(str(formats[index].formatDirName) for index in indices)), error)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+      _buildState = None
+    if failures:
+      raise RuntimeError("%d build tasks failed" % failures)
+
+    # Workers adjusted content paths in their own copies of the sources,
+    # redo the last format's adjustments so indexing sees serial build state
+    if formats:
+      format = formats[-1]
       for group in self.groups.itervalues():
-        group.build(format)
-
-    for group in self.groups.itervalues():
-      indexer.indexGroup(group)
-
-    for format in formats:
-      indexer.writeIndex(format)
-
-
-    rawtests = []
-    for src, relpath in self.rawgroups.items():
-      copytree(src, join(dest,relpath))
-      for (root, dirs, files) in os.walk(join(dest,relpath)):
-        for xdir in excludeDirs:
-          if xdir in dirs:
-            dirs.remove(xdir)
-            rmtree(join(root,xdir))
-        rawtests.extend(
-          [join(Utils.relpath(root,dest),file)
-           for file in files]
-        )
-
-    rawtests.sort()
-    indexer.writeOverview(dest, addTests=rawtests)
-    
+        BuildProfile.setContext(format, group)
+        format.setSubDir(group.name)
+        group.tests.adjustContentPaths(format)
+      format.setSubDir()
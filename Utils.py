@@ -12,7 +12,11 @@ os.environ['XML_CATALOG_FILES'] = os.path.join(w3ctestlib.__path__[0], 'catalog/
 ###### File path manipulation ######
 
 import os.path
-from os.path import sep, pardir
+import mmap
+import shutil
+import hashlib
+import tempfile
+from os.path import sep, pardir, dirname
 
 def assetName(path):
   return intern(os.path.splitext(os.path.basename(path))[0].lower().encode('ascii'))
@@ -99,6 +103,101 @@ def listdirs(path):
     dirs = []
   return dirs
 
+def fileDigest(path):
+  """ Returns the SHA-1 digest of the contents of the file at `path`.
+      The file is mapped rather than read into memory.
+  """
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if (not size):
+      return hashlib.sha1().digest()
+    data = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+    try:
+      return hashlib.sha1(data).digest()
+    finally:
+      data.close()
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+class AtomicFile:
+  """ File object for writing a replacement for the file at `path`.
+      Output goes to a temporary file next to `path`, which is renamed
+      over `path` by close(), so readers never see a partial file and
+      hard links to the old file keep their contents.
+  """
+  def __init__(self, path):
+    self.path = path
+    fd, self.tempPath = tempfile.mkstemp(dir = dirname(path) or '.')
+    self.file = os.fdopen(fd, 'wb')
+
+  def write(self, data):
+    self.file.write(data)
+
+  def tell(self):
+    return self.file.tell()
+
+  def close(self):
+    self.file.close()
+    os.chmod(self.tempPath, 0666 & ~_umask)
+    os.rename(self.tempPath, self.path)
+
+  def discard(self):
+    self.file.close()
+    os.remove(self.tempPath)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    if type:
+      self.discard()
+    else:
+      self.close()
+    return False
+
+def writeFile(path, data):
+  """ Atomically replace the file at `path` with byte string `data`.
+  """
+  with AtomicFile(path) as f:
+    f.write(data)
+
+def copyFile(src, dest):
+  """ Atomically replace file `dest` with a copy of `src`, like shutil.copy2.
+  """
+  fd, tempPath = tempfile.mkstemp(dir = dirname(dest) or '.')
+  os.close(fd)
+  try:
+    shutil.copy2(src, tempPath)
+  except:
+    os.remove(tempPath)
+    raise
+  os.rename(tempPath, dest)
+
+def fileMatches(path, size, digest):
+  """ Returns True if the file at `path` has `size` bytes and SHA-1
+      digest `digest`.
+  """
+  try:
+    return (os.path.getsize(path) == size) and (fileDigest(path) == digest)
+  except (IOError, OSError):
+    return False
+
+def copyTree(src, dest, excludeDirs = (), copy = copyFile):
+  """ Copy directory tree `src` into `dest` file by file with function
+      `copy`, skipping directories named in `excludeDirs`. Unlike
+      shutil.copytree, `dest` may exist already.
+  """
+  for root, dirs, files in os.walk(src):
+    for dir in excludeDirs:
+      if dir in dirs:
+        dirs.remove(dir)
+    destDir = os.path.join(dest, relpath(root, src))
+    if not os.path.exists(destDir):
+      os.makedirs(destDir)
+    for name in files:
+      copy(os.path.join(root, name), os.path.join(destDir, name))
+
 ###### MIME types and file extensions ######
 
 extensionMap = { None     : 'application/octet-stream', # default
@@ -123,11 +222,18 @@ def getMimeFromExt(filepath):
 
 ###### Escaping ######
 
+import re
 import types
 from htmlentitydefs import entitydefs
 
 entityify = dict([c,e] for e,c in entitydefs.iteritems())
 
+# named references for the non-ASCII Latin-1 characters, see escapeToNamed
+namedUnicodeRefs = dict((unichr(ord(c)), u'&%s;' % e) for c, e in entityify.iteritems()
+                        if (1 == len(c)) and (127 < ord(c)))
+nonASCIIUnicodeRE = re.compile(u'[^\x00-\x7f]')
+nonASCIIStringRE = re.compile('[\x80-\xff]')
+
 def escapeMarkup(data):
   """Escape markup characters (&, >, <). Copied from xml.sax.saxutils.
   """
@@ -145,17 +251,6 @@ def escapeToNamedASCII(text):
 def escapeToNamed(text):
   """Escape characters with named entities.
   """
-  escapable = set()
-
-  for c in text:
-    if ord(c) > 127:
-      escapable.add(c)
   if type(text) == types.UnicodeType:
-    for c in escapable:
-      cLatin = c.encode('Latin-1', 'ignore')
-      if (cLatin in entityify):
-        text = text.replace(c, "&%s;" % entityify[cLatin])
-  else:
-    for c in escapable:
-      text = text.replace(c, "&%s;" % entityify[c])
-  return text
+    return nonASCIIUnicodeRE.sub(lambda m: namedUnicodeRefs.get(m.group(), m.group()), text)
+  return nonASCIIStringRE.sub(lambda m: "&%s;" % entityify[m.group()], text)
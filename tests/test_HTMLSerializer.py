@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+import os
+import sys
+import codecs
+import unittest
+from io import BytesIO
+import html5lib
+
+# import the library as the w3ctestlib package this checkout is
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from w3ctestlib.HTMLSerializer import HTMLSerializer
+
+class HTMLSerializerTest(unittest.TestCase):
+
+  def largeTree(self):
+    """Parse a BOM-prefixed source large enough to be flushed many times."""
+    paragraphs = ''.join('<p>Paragraph %d \xc3\xa9</p>' % index
+                         for index in range(4 * HTMLSerializer.gFlushChunks))
+    data = codecs.BOM_UTF8 + '<!DOCTYPE html><title>Test</title>' + paragraphs
+    return html5lib.parse(data, treebuilder = 'lxml', namespaceHTMLElements = False)
+
+  def assertSingleBOM(self, encoding, bom):
+    tree = self.largeTree()
+    serializer = HTMLSerializer()
+    stream = BytesIO()
+    serializer.writeXHTML(tree, stream, encoding = encoding)
+    output = stream.getvalue()
+    self.assertTrue(output.startswith(bom))
+    self.assertEqual(output.count(bom), 1)
+    self.assertEqual(output.decode(encoding), serializer.serializeXHTML(tree))
+
+  def testUTF8BOM(self):
+    self.assertSingleBOM('utf-8-sig', codecs.BOM_UTF8)
+
+  def testUTF16BOM(self):
+    self.assertSingleBOM('utf-16', codecs.BOM_UTF16)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# import the library as the w3ctestlib package this checkout is
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from w3ctestlib.OutputFormats import BuildManifest
+
+class BuildManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.src = os.path.join(self.tempDir, 'src')
+    self.dest = os.path.join(self.tempDir, 'dest')
+    os.makedirs(self.src)
+    os.makedirs(self.dest)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def writeSource(self, name, data):
+    with open(os.path.join(self.src, name), 'wb') as f:
+      f.write(data)
+
+  def readOutput(self, name):
+    with open(os.path.join(self.dest, name), 'rb') as f:
+      return f.read()
+
+  def build(self):
+    manifest = BuildManifest(self.dest)
+    manifest.copyTree(self.src, self.dest)
+    manifest.close()
+
+  def testSameSizeEdit(self):
+    self.writeSource('support.css', 'p { color: red; }')
+    self.build()
+    self.assertEqual(self.readOutput('support.css'), 'p { color: red; }')
+    stat = os.stat(os.path.join(self.src, 'support.css'))
+    self.writeSource('support.css', 'p { color: tan; }')
+    os.utime(os.path.join(self.src, 'support.css'), (stat.st_atime, stat.st_mtime))
+    self.build()
+    self.assertEqual(self.readOutput('support.css'), 'p { color: tan; }')
+
+  def testUnchangedSkipped(self):
+    self.writeSource('support.css', 'p { color: red; }')
+    self.build()
+    copied = []
+    manifest = BuildManifest(self.dest)
+    manifest.copyTree(self.src, self.dest, copy = lambda src, dest: copied.append(src))
+    manifest.close()
+    self.assertEqual(copied, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# CSS Test Suite Manipulation Library
+# Licensed under BSD 3-Clause: <http://www.w3.org/Consortium/Legal/2008/03-bsd-license>
+
+import os
+import sys
+import copy
+import pickle
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+# import the library as the w3ctestlib package this checkout is
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from w3ctestlib.Sources import Metadata, ReferenceData, SourceTree
+from w3ctestlib.Repositories import GitRepository
+
+class NamedDictTest(unittest.TestCase):
+
+  def metadata(self):
+    return Metadata(name = 'test-001', title = 'Test', asserts = ['Passes.'],
+                    credits = [('Author', 'mailto:author@example.org')], flags = ['ahem'],
+                    links = ['http://www.w3.org/TR/CSS21/box.html#x'],
+                    references = [[ReferenceData('ref', '==', 'reference/ref.xht', 'src/reference/ref.xht')]],
+                    revision = 'abc', scripttest = True)
+
+  def assertSameRecord(self, clone, data):
+    self.assertIsInstance(clone, Metadata)
+    self.assertEqual(clone, data)
+    self.assertEqual(clone.items(), data.items())
+    self.assertIsInstance(clone.references[0][0], ReferenceData)
+    self.assertEqual(clone.references[0][0].relpath, 'reference/ref.xht')
+
+  def testCopy(self):
+    data = self.metadata()
+    clone = copy.copy(data)
+    self.assertSameRecord(clone, data)
+    self.assertIs(clone.references, data.references)
+    clone['title'] = 'Changed'
+    self.assertEqual(data['title'], 'Test')
+
+  def testDeepCopy(self):
+    data = self.metadata()
+    clone = copy.deepcopy(data)
+    self.assertSameRecord(clone, data)
+    self.assertIsNot(clone.references, data.references)
+
+  def testPickle(self):
+    data = self.metadata()
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      self.assertSameRecord(pickle.loads(pickle.dumps(data, protocol)), data)
+
+class SourceTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    for name in ('tracked-001.xht', 'untracked-001.xht'):
+      with open(os.path.join(self.root, name), 'w') as f:
+        f.write('<html xmlns="http://www.w3.org/1999/xhtml"/>')
+    subprocess.check_call(['git', 'init', '-q'], cwd = self.root)
+    subprocess.check_call(['git', 'add', 'tracked-001.xht'], cwd = self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def testUntrackedExcluded(self):
+    sourceTree = SourceTree(GitRepository(self.root))
+    self.assertTrue(sourceTree.isTestCase(os.path.join(self.root, 'tracked-001.xht')))
+    self.assertFalse(sourceTree.isTestCase(os.path.join(self.root, 'untracked-001.xht')))
+
+  def testWithoutRepository(self):
+    sourceTree = SourceTree()
+    self.assertTrue(sourceTree.isTestCase(os.path.join(self.root, 'untracked-001.xht')))
+
+if __name__ == '__main__':
+  unittest.main()